@@ -0,0 +1,220 @@
+"""
+Ingestion throughput benchmark. Drives MqttClient with a fake gmqtt
+client and synthetic sensor payloads, uploading to a local metcloud
+stand-in. Reading timestamps come from a fake clock advancing one
+sensor interval per round of stations, so uploads happen as they would
+in service. Each configuration runs in a fresh process and the results
+are written as JSON.
+
+    python bench/bench_ingest.py [--stations 1 10 100] [--rates 0 1000]
+                                 [--messages 20000] [--output results.json]
+
+A rate of 0 sends messages as fast as possible.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from metcloud_stub import MetcloudStub
+
+# Sensor result interval (seconds) and fake clock start
+RESULT_INTERVAL = 60
+START_TIME = 1767225600
+
+# Longest wait for the uploader to empty the outbox (seconds)
+DRAIN_TIMEOUT = 60
+
+class FakeMqtt:
+    """
+    Minimal stand-in for gmqtt.Client
+    """
+    def __init__(self):
+        self.on_connect = None
+        self.on_message = None
+        self.subscriptions = []
+        self.published = 0
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published += 1
+
+    async def connect(self, host, version=None):
+        self.on_connect(self, 0, 0, None)
+
+    async def disconnect(self):
+        pass
+
+class FakeTime:
+    """
+    time module for metlog.metlog with time() from the fake clock
+    """
+    def __init__(self, now):
+        self.now = now
+        self.perf_counter = time.perf_counter
+
+    def time(self):
+        return self.now
+
+def payloads(stations, count):
+    # Pre-generate payloads so encoding isn't included in timings
+    topics = ["metsensor/st%03d/results" % i for i in range(stations)]
+    msgs = []
+    for i in range(count):
+        result = {'wind': random.uniform(0, 15),
+                  'gust': random.uniform(0, 25),
+                  'temp': random.uniform(-5, 30),
+                  'reset_cause': 1,
+                  'up_count': i,
+                  'fan': 'off'}
+        msgs.append((topics[i % stations], json.dumps(result).encode()))
+
+    return msgs
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def drive(client, mqtt, msgs, stations, rate, clock):
+    loop = asyncio.get_running_loop()
+    client.writer.on_outbox = lambda: loop.call_soon_threadsafe(client.uploader.notify)
+
+    client.writer.start()
+    client.uploader.start()
+    await mqtt.connect("localhost")
+
+    latency = []
+    on_message = client.on_message
+    interval = 1 / rate if rate else 0
+
+    start = time.perf_counter()
+    for n, (topic, payload) in enumerate(msgs):
+        clock.now = START_TIME + n // stations * RESULT_INTERVAL
+
+        t = time.perf_counter()
+        on_message(mqtt, topic, payload, 0, None)
+        latency.append(time.perf_counter() - t)
+
+        if interval:
+            delay = start + (n + 1) * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif n % 100 == 0:
+            # Let the uploader run
+            await asyncio.sleep(0)
+
+    send_time = time.perf_counter() - start
+
+    # Wait for database to catch up
+    client.writer.stop()
+    total_time = time.perf_counter() - start
+
+    # Then for the uploader to catch up
+    dbc = sqlite3.connect(client.db_file)
+    deadline = time.perf_counter() + DRAIN_TIMEOUT
+    while True:
+        outbox = dbc.execute("select count(*) from outbox").fetchone()[0]
+        if not outbox or time.perf_counter() > deadline:
+            break
+        await asyncio.sleep(0.05)
+    dbc.close()
+    upload_time = time.perf_counter() - start
+
+    await client.uploader.stop()
+
+    return latency, send_time, total_time, upload_time, outbox
+
+def run_config(stations, rate, messages):
+    from metlog import MqttClient, Sun, init_db
+    import metlog.metlog
+
+    stub = MetcloudStub()
+    stub.start()
+    metlog.metlog.METCLOUD = stub.url
+
+    msgs = payloads(stations, messages)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_file = os.path.join(tmpdir, "metlog.db")
+        init_db(db_file)
+
+        mqtt = FakeMqtt()
+        client = MqttClient(mqtt, db_file, Sun(51.0, -1.6),
+                            metcloud_batch=stub.url + "batch")
+
+        clock = FakeTime(START_TIME)
+        metlog.metlog.time = clock
+        latency, send_time, total_time, upload_time, outbox = asyncio.run(
+            drive(client, mqtt, msgs, stations, rate, clock))
+
+        # Include WAL file in database size
+        db_bytes = sum(os.path.getsize(os.path.join(tmpdir, f)) for f in os.listdir(tmpdir))
+
+    stats = stub.stats()
+    stub.stop()
+    latency.sort()
+
+    return {'stations': stations,
+            'rate': rate,
+            'messages': messages,
+            'throughput': messages / total_time,
+            'send_throughput': messages / send_time,
+            'latency_p50_us': percentile(latency, 50) * 1e6,
+            'latency_p99_us': percentile(latency, 99) * 1e6,
+            'db_bytes_per_row': db_bytes / messages,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'uploads': stats['requests'],
+            'upload_entries': stats['entries'],
+            'upload_seconds': upload_time,
+            'outbox_left': outbox}
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=os.path.dirname(__file__),
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--rates", type=float, nargs="+", default=[0, 1000])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--output", help="Output file (default stdout)")
+    args = parser.parse_args()
+
+    # Fresh process for each configuration so peak memory is per run
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for stations in args.stations:
+        for rate in args.rates:
+            with ctx.Pool(1) as pool:
+                result = pool.apply(run_config, (stations, rate, args.messages))
+            print("stations %(stations)d rate %(rate)g: %(throughput).0f msg/s, "
+                  "p50 %(latency_p50_us).1f us, p99 %(latency_p99_us).1f us, "
+                  "%(upload_entries)d uploaded" % result,
+                  file=sys.stderr)
+            results.append(result)
+
+    report = {'version': version(), 'python': sys.version.split()[0],
+              'results': results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,83 @@
+"""
+Query latency against table size. Builds one-minute databases of
+increasing size and times each of the metlog.query functions. aggregate
+reads whole buckets from the hourly rollup table, grouped computes the
+same buckets from the raw readings.
+
+    python bench/bench_query.py [--sizes 10000 100000 1000000]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from metlog import init_db
+from metlog import query
+from metlog import rollup
+
+START = datetime(2010, 1, 1)
+
+def build_db(db_file, size):
+    init_db(db_file)
+
+    dbc = sqlite3.connect(db_file)
+    rows = ((START + timedelta(minutes=i),
+             random.uniform(0, 15), random.uniform(0, 25), random.uniform(-5, 30))
+            for i in range(size))
+    with dbc:
+        dbc.executemany("insert into metlog (ts, wind, gust, temp) values (?, ?, ?, ?)",
+                        rows)
+        rollup.rebuild(dbc)
+    dbc.close()
+
+def timeit(fn, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        fn()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+
+    return best * 1000
+
+def bench(size, repeat):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_file = os.path.join(tmpdir, "metlog.db")
+        build_db(db_file, size)
+
+        dbc = query.connect(db_file)
+
+        # Query a day of data from the middle of the table
+        mid = START + timedelta(minutes=size // 2)
+        day = mid + timedelta(days=1)
+
+        results = {
+            'readings_between': timeit(lambda: query.readings_between(dbc, mid, day), repeat),
+            'latest': timeit(lambda: query.latest(dbc, 60), repeat),
+            'aggregate': timeit(lambda: query.aggregate(dbc, mid, day, 3600), repeat),
+            'grouped': timeit(lambda: query.grouped(dbc, mid, day, 3600), repeat)}
+
+        dbc.close()
+
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("%10s %18s %10s %10s %10s" % ("rows", "readings_between", "latest", "aggregate",
+                                        "grouped"))
+    for size in args.sizes:
+        r = bench(size, args.repeat)
+        print("%10d %15.3f ms %7.3f ms %7.3f ms %7.3f ms" %
+              (size, r['readings_between'], r['latest'], r['aggregate'], r['grouped']))
@@ -0,0 +1,113 @@
+"""
+Local stand-in for the metcloud server. Accepts PUT requests to any
+path and gzipped POST batches to /batch, optionally with an added
+delay or failure rate.
+
+    python bench/metcloud_stub.py [--port 8080] [--delay 0.1] [--fail 0.2]
+"""
+import gzip
+import http.server
+import json
+import random
+import threading
+import time
+
+class MetcloudHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        self.handle_upload(False)
+
+    def do_POST(self):
+        if self.path == "/batch":
+            self.handle_upload(True)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def handle_upload(self, batch):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        if random.random() < server.fail:
+            status = 503
+        else:
+            status = 200
+            if batch:
+                if self.headers.get('Content-Encoding') == "gzip":
+                    entries = json.loads(gzip.decompress(body))
+                else:
+                    entries = json.loads(body)
+                paths = ["/" + e['station'] for e in entries]
+            else:
+                paths = [self.path]
+
+            with server.lock:
+                server.requests += 1
+                server.batches += batch
+                server.bytes += len(body)
+                for path in paths:
+                    server.entries += 1
+                    server.paths[path] = server.paths.get(path, 0) + 1
+
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class MetcloudStub(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, delay=0, fail=0):
+        super().__init__(("127.0.0.1", port), MetcloudHandler)
+        self.delay = delay
+        self.fail = fail
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.entries = 0
+        self.bytes = 0
+        self.paths = {}
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'batches': self.batches,
+                    'entries': self.entries, 'bytes': self.bytes,
+                    'paths': len(self.paths)}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--delay", type=float, default=0,
+                        help="Response delay (seconds)")
+    parser.add_argument("--fail", type=float, default=0,
+                        help="Fraction of requests to fail")
+    args = parser.parse_args()
+
+    stub = MetcloudStub(args.port, args.delay, args.fail)
+    print("Listening on", stub.url)
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(stub.stats()))
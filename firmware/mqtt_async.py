@@ -0,0 +1,230 @@
+import uasyncio as asyncio
+import ustruct as struct
+import utime as time
+
+from mqtt_simple import MQTTException
+
+# Most packets waiting to be sent, oldest are dropped when full
+QUEUE_SIZE = 16
+
+# Keepalive (seconds), a ping is sent every keepalive / 2 seconds and the
+# connection is dropped if nothing is heard for 1.5 * keepalive
+KEEPALIVE = 60
+
+CONNECT_TIMEOUT = 10
+
+# Reconnect backoff limits (seconds)
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+
+def _str(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return struct.pack("!H", len(s)) + s
+
+def _packet(op, body):
+    # Fixed header with variable length remaining length
+    hdr = bytearray(5)
+    hdr[0] = op
+    sz = len(body)
+    i = 1
+    while sz > 0x7f:
+        hdr[i] = (sz & 0x7f) | 0x80
+        sz >>= 7
+        i += 1
+    hdr[i] = sz
+    return bytes(hdr[:i + 1]) + body
+
+class MQTTClient:
+    """
+    Non-blocking MQTT client for uasyncio. publish() and subscribe() only
+    queue a packet so they can be called from the sensor timer callback,
+    run() connects, sends queued packets, keeps the connection alive with
+    pings and reconnects with backoff when the broker goes away. Only QoS 0
+    publish is supported.
+    """
+    def __init__(self, client_id, server, port=1883, keepalive=KEEPALIVE,
+                 queue_size=QUEUE_SIZE):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.queue_size = queue_size
+
+        self.cb = None
+        self.pid = 0
+        self.subscriptions = []
+
+        self.queue = []
+        self.dropped = 0
+
+        # Packet at the head of the queue being written
+        self.sending = None
+
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.last_rx = 0
+
+        # Set from the timer callback when a packet is queued
+        self.flag = asyncio.ThreadSafeFlag()
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def subscribe(self, topic, qos=0):
+        # Subscriptions are made again on every connect
+        assert self.cb is not None, "Subscribe callback is not set"
+        self.subscriptions.append((topic, qos))
+        if self.connected:
+            self._queue(self._subscribe_packet(topic, qos))
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        assert qos == 0
+        self._queue(_packet(0x30 | retain, _str(topic) + msg))
+
+    def _queue(self, pkt):
+        if len(self.queue) >= self.queue_size:
+            # Drop the oldest not already being written
+            self.queue.pop(1 if self.queue[0] is self.sending else 0)
+            self.dropped += 1
+        self.queue.append(pkt)
+        self.flag.set()
+
+    def _subscribe_packet(self, topic, qos):
+        self.pid = self.pid % 65535 + 1
+        return _packet(0x82, struct.pack("!H", self.pid) + _str(topic) + bytes((qos,)))
+
+    def _connect_packet(self):
+        return _packet(0x10, b"\x00\x04MQTT\x04\x02" + struct.pack("!H", self.keepalive) +
+                       _str(self.client_id))
+
+    async def run(self):
+        backoff = BACKOFF_MIN
+        while True:
+            try:
+                await self._connect()
+                backoff = BACKOFF_MIN
+                await self._session()
+
+            except (OSError, EOFError, MQTTException, asyncio.TimeoutError) as e:
+                print("MQTT error:", repr(e))
+
+            except Exception as e:
+                # Reconnect rather than end the task
+                print("MQTT unexpected error:", repr(e))
+
+            await self._close()
+
+            print("MQTT reconnect in", backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, BACKOFF_MAX)
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port), CONNECT_TIMEOUT)
+
+        self.writer.write(self._connect_packet())
+        await self.writer.drain()
+
+        resp = await asyncio.wait_for(self.reader.readexactly(4), CONNECT_TIMEOUT)
+        if resp[0] != 0x20 or resp[1] != 0x02:
+            raise MQTTException(-1)
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+
+        for topic, qos in self.subscriptions:
+            self.writer.write(self._subscribe_packet(topic, qos))
+        await self.writer.drain()
+
+        self.connected = True
+        self.last_rx = time.ticks_ms()
+        print("MQTT connected")
+
+    async def _session(self):
+        receiver = asyncio.create_task(self._receive())
+        ping_ms = self.keepalive * 500
+        last_ping = time.ticks_ms()
+        try:
+            while True:
+                # Packets stay queued until written
+                while self.queue:
+                    self.sending = self.queue[0]
+                    self.writer.write(self.sending)
+                    await self.writer.drain()
+                    self.queue.pop(0)
+                    self.sending = None
+
+                # Ping on schedule even while publishing, so the broker
+                # always answers within the keepalive check
+                wait = ping_ms - time.ticks_diff(time.ticks_ms(), last_ping)
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for_ms(self.flag.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+
+                if time.ticks_diff(time.ticks_ms(), last_ping) >= ping_ms:
+                    self.writer.write(b"\xc0\0")
+                    await self.writer.drain()
+                    last_ping = time.ticks_ms()
+
+                if not self.connected:
+                    raise OSError(-1)
+
+                if time.ticks_diff(time.ticks_ms(), self.last_rx) > self.keepalive * 1500:
+                    raise OSError("keepalive timeout")
+
+        finally:
+            receiver.cancel()
+
+    async def _receive(self):
+        try:
+            while True:
+                op = (await self.reader.readexactly(1))[0]
+
+                sz = 0
+                sh = 0
+                while True:
+                    b = (await self.reader.readexactly(1))[0]
+                    sz |= (b & 0x7f) << sh
+                    if not b & 0x80:
+                        break
+                    sh += 7
+
+                data = await self.reader.readexactly(sz) if sz else b""
+                self.last_rx = time.ticks_ms()
+
+                if op & 0xf0 != 0x30:
+                    # CONNACK, SUBACK, PINGRESP
+                    continue
+
+                topic_len = data[0] << 8 | data[1]
+                pos = 2 + topic_len
+                if op & 6:
+                    pid = data[pos:pos + 2]
+                    pos += 2
+                    if op & 6 == 2:
+                        self._queue(b"\x40\x02" + pid)
+
+                self.cb(data[2:2 + topic_len], data[pos:])
+
+        except (OSError, EOFError) as e:
+            print("MQTT receive error:", repr(e))
+
+        self.connected = False
+        self.flag.set()
+
+    async def _close(self):
+        self.connected = False
+        self.sending = None
+        if self.writer is not None:
+            # uasyncio Stream.close() does nothing, the socket is only
+            # closed by wait_closed()
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.reader = None
+            self.writer = None
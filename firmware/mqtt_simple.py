@@ -1,6 +1,15 @@
+import uselect as select
 import usocket as socket
 import ustruct as struct
-from ubinascii import hexlify
+
+# Preallocated packet buffer size, larger publishes are written in parts
+PACKET_SIZE = 256
+
+# Most encoded topic headers kept for reuse
+TOPIC_CACHE_SIZE = 8
+
+# Receive buffer size, the largest packet that can be received
+RECV_SIZE = 512
 
 class MQTTException(Exception):
     pass
@@ -27,19 +36,96 @@ class MQTTClient:
         self.lw_qos = 0
         self.lw_retain = False
 
+        self.buf = bytearray(PACKET_SIZE)
+        self.mv = memoryview(self.buf)
+        self.topics = {}
+
+        # Received data is rbuf[rstart:rend]
+        self.rbuf = bytearray(RECV_SIZE)
+        self.rmv = memoryview(self.rbuf)
+        self.rstart = 0
+        self.rend = 0
+        self.poller = None
+
+        # Body of the last packet returned by wait_msg()
+        self.resp = None
+
     def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+        if isinstance(s, str):
+            s = s.encode()
+        self.sock.write(struct.pack("!H", len(s)) + s)
+
+    def _topic_header(self, topic):
+        # Topic length and topic, cached for the fixed topics we publish
+        hdr = self.topics.get(topic)
+        if hdr is None:
+            t = topic.encode() if isinstance(topic, str) else topic
+            hdr = struct.pack("!H", len(t)) + t
+            if len(self.topics) < TOPIC_CACHE_SIZE:
+                self.topics[topic] = hdr
+        return hdr
 
-    def _recv_len(self):
-        n = 0
+    # Read whatever is available into the receive buffer, waiting up to
+    # timeout ms (-1 waits forever). The socket is only made non-blocking
+    # for the read once poll has reported data.
+    def _fill(self, timeout):
+        n = self.rend - self.rstart
+        if self.rstart > 0:
+            # Move a partial packet to the start of the buffer
+            if n:
+                self.rbuf[:n] = self.rmv[self.rstart:self.rend]
+            self.rstart = 0
+            self.rend = n
+        if self.rend == len(self.rbuf):
+            raise MQTTException("packet too large")
+
+        if not self.poller.poll(timeout):
+            return 0
+        self.sock.setblocking(False)
+        try:
+            n = self.sock.readinto(self.rmv[self.rend:])
+        finally:
+            self.sock.setblocking(True)
+        if n is None:
+            return 0
+        if n == 0:
+            raise OSError(-1)
+        self.rend += n
+        return n
+
+    # Next complete packet in the receive buffer as (op, body memoryview),
+    # or None
+    def _parse(self):
+        buf = self.rbuf
+        i = self.rstart
+        end = self.rend
+        if end - i < 2:
+            return None
+        op = buf[i]
+        i += 1
+        sz = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
-            n |= (b & 0x7f) << sh
+            if i == end:
+                return None
+            b = buf[i]
+            i += 1
+            sz |= (b & 0x7f) << sh
             if not b & 0x80:
-                return n
+                break
             sh += 7
+        if end - i < sz:
+            return None
+        self.rstart = i + sz
+        return op, self.rmv[i:i + sz]
+
+    def _next(self, timeout):
+        while 1:
+            pkt = self._parse()
+            if pkt is not None:
+                return pkt
+            if not self._fill(timeout):
+                return None
 
     def set_callback(self, f):
         self.cb = f
@@ -85,7 +171,6 @@ class MQTTClient:
 
         self.sock.write(premsg, i + 2)
         self.sock.write(msg)
-        #print(hex(len(msg)), hexlify(msg, ":"))
         self._send_str(self.client_id)
         if self.lw_topic:
             self._send_str(self.lw_topic)
@@ -97,6 +182,12 @@ class MQTTClient:
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
+
+        # Further reads go through the receive buffer
+        self.rstart = 0
+        self.rend = 0
+        self.poller = select.poll()
+        self.poller.register(self.sock, select.POLLIN)
         return resp[2] & 1
 
     def disconnect(self):
@@ -107,35 +198,55 @@ class MQTTClient:
         self.sock.write(b"\xc0\0")
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
+        # Whole packet is assembled in the preallocated buffer and sent
+        # with one write
+        if isinstance(msg, str):
+            msg = msg.encode()
+        hdr = self._topic_header(topic)
+        pkt = self.buf
+        pkt[0] = 0x30 | qos << 1 | retain
+        sz = len(hdr) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
+        n = sz
         i = 1
         while sz > 0x7f:
             pkt[i] = (sz & 0x7f) | 0x80
             sz >>= 7
             i += 1
         pkt[i] = sz
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        i += 1
+        n += i
+
         if qos > 0:
             self.pid += 1
             pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
+
+        if n <= len(pkt):
+            mv = self.mv
+            mv[i:i + len(hdr)] = hdr
+            i += len(hdr)
+            if qos > 0:
+                struct.pack_into("!H", pkt, i, pid)
+                i += 2
+            mv[i:n] = msg
+            self.sock.write(pkt, n)
+        else:
+            self.sock.write(pkt, i)
+            self.sock.write(hdr)
+            if qos > 0:
+                struct.pack_into("!H", pkt, 0, pid)
+                self.sock.write(pkt, 2)
+            self.sock.write(msg)
+
         if qos == 1:
             while 1:
                 op = self.wait_msg()
                 if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+                    resp = self.resp
+                    assert len(resp) == 2
+                    rcv_pid = resp[0] << 8 | resp[1]
                     if pid == rcv_pid:
                         return
         elif qos == 2:
@@ -143,52 +254,48 @@ class MQTTClient:
 
     def subscribe(self, topic, qos=0):
         assert self.cb is not None, "Subscribe callback is not set"
+        if isinstance(topic, str):
+            topic = topic.encode()
         pkt = bytearray(b"\x82\0\0\0")
         self.pid += 1
         struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
         self.sock.write(pkt)
         self._send_str(topic)
         self.sock.write(qos.to_bytes(1, "little"))
         while 1:
             op = self.wait_msg()
             if op == 0x90:
-                resp = self.sock.read(4)
-                #print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+                resp = self.resp
+                #print(bytes(resp))
+                assert resp[0] == pkt[2] and resp[1] == pkt[3]
+                if resp[2] == 0x80:
+                    raise MQTTException(resp[2])
                 return
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
-    # set by .set_callback() method. Other (internal) MQTT
-    # messages processed internally.
+    # set by .set_callback() method, topic and message are memoryviews
+    # into the receive buffer that are only valid during the callback.
+    # Other (internal) MQTT messages processed internally, the body of
+    # any other packet is left in self.resp and its op returned.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
+        return self._handle(self._next(-1))
+
+    def _handle(self, pkt):
+        if pkt is None:
             return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
+        op, body = pkt
+        if op == 0xd0:  # PINGRESP
             return None
-        op = res[0]
         if op & 0xf0 != 0x30:
+            self.resp = body
             return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
+        topic_len = (body[0] << 8) | body[1]
+        pos = 2 + topic_len
         if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
+            pid = body[pos] << 8 | body[pos + 1]
+            pos += 2
+        self.cb(body[2:2 + topic_len], body[pos:])
         if op & 6 == 2:
             pkt = bytearray(b"\x40\x02\0\0")
             struct.pack_into("!H", pkt, 2, pid)
@@ -196,9 +303,11 @@ class MQTTClient:
         elif op & 6 == 4:
             assert 0
 
-    # Checks whether a pending message from server is available.
-    # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+    # Processes every complete message received so far (e.g. several
+    # retained messages after subscribing) and returns without waiting.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
+        while 1:
+            pkt = self._next(0)
+            if pkt is None:
+                return None
+            self._handle(pkt)
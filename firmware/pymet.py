@@ -1,10 +1,15 @@
+from array import array
 import machine
 import micropython
+import uasyncio as asyncio
 import ujson as json
 import uos as os
+import ustruct as struct
 import utime as time
 
 from mqtt_simple import MQTTClient
+from mqtt_async import MQTTClient as AsyncMQTTClient
+from store import ResultStore
 
 from ds18x20 import DS18X20
 from onewire import OneWire, OneWireError
@@ -12,14 +17,58 @@ from onewire import OneWire, OneWireError
 TEMP_ONEWIRE_PIN = "PE11"
 TEMP_FAN_PIN = "PA6"
 
+# Most DS18x20 probes read, the first is the screen temperature
+TEMP_MAX_PROBES = 4
+
+# 100ms ticks to wait for a 12 bit conversion (750ms) before reading
+TEMP_CONVERT_TICKS = 8
+
 WIND_ADC_PIN = "PA3"
 
+# Accumulate raw ADC counts with integer arithmetic (RawWindSensor)
+# instead of converting every sample to m/s (WindSensor)
+WIND_RAW_SAMPLING = True
+
+# Sample wind at WIND_SAMPLE_RATE (Hz) for 3 second gusts and turbulence
+# (HighRateWindSensor), otherwise at 10 Hz
+WIND_HIGH_RATE = True
+WIND_SAMPLE_RATE = 50
+
 BLUE_LED_PIN = "PB7"
 
 MQTT_SERVER = "192.168.1.100"
 
+# Use the uasyncio MQTT client (publish never blocks, reconnects with
+# backoff) instead of polling mqtt_simple from the timer callback
+MQTT_ASYNC = True
+
+# Keep binary results in flash while the broker is unreachable and replay
+# them in batches after reconnecting (needs MQTT_ASYNC)
+RESULTS_STORE = True
+RESULTS_STORE_DIR = "/flash/results"
+
+# Publish results as a binary record (see metlog/payload.py) instead of JSON
+BINARY_RESULTS = True
+
+RESULTS_VERSION = 1
+RESULTS_FORMAT = "<BBBhhhI"
+RESULTS_FLAG_FAN = 0x01
+
+# Version 2 adds 3 second gust and wind standard deviation
+RESULTS_VERSION_2 = 2
+RESULTS_FORMAT_2 = "<BBBhhhIhh"
+
+# Version 3 adds a probe count and per-probe temperatures (h each), gust3
+# and wind_sd are RESULTS_NONE without a high rate wind sensor
+RESULTS_VERSION_3 = 3
+RESULTS_FORMAT_3 = "<BBBhhhIhhB"
+RESULTS_NONE = -32768
+
 NOSTART_FILE = "/flash/nostart"
 
+# Control messages from metlog are metlog/<name>
+CONTROL_PREFIX = b"metlog/"
+
 def is_nostart(reset):
     try:
         f = open(NOSTART_FILE)
@@ -36,6 +85,35 @@ def is_nostart(reset):
 
     return ret
 
+# Received topics and messages are memoryviews into the MQTT receive
+# buffer, these compare and parse them in place without allocating
+
+def bytes_at(buf, pos, s):
+    # True if buf holds s at pos
+    if len(buf) < pos + len(s):
+        return False
+    for i in range(len(s)):
+        if buf[pos + i] != s[i]:
+            return False
+    return True
+
+def is_control(topic, name):
+    # True if topic is CONTROL_PREFIX + name, prefix already checked
+    return (len(topic) == len(CONTROL_PREFIX) + len(name) and
+            bytes_at(topic, len(CONTROL_PREFIX), name))
+
+def parse_int(buf):
+    # Non-negative decimal integer
+    if not len(buf):
+        raise ValueError
+    n = 0
+    for i in range(len(buf)):
+        c = buf[i] - 48
+        if c < 0 or c > 9:
+            raise ValueError
+        n = n * 10 + c
+    return n
+
 class Led():
     def __init__(self, pin=None):
         if pin:
@@ -60,6 +138,9 @@ class Led():
 # Wind sensor
 
 class WindSensor:
+    # result() returns (wind, gust)
+    extended = False
+
     # avg_size is number of samples to combine in a measurement
     def __init__(self, pin, avg_size):
         self.adc = machine.ADC(pin)
@@ -116,10 +197,190 @@ class WindSensor:
 
         return wind, gust
 
+# Optional viper ring buffer update, returns change in window sum
+try:
+    from wind_viper import ring_update
+except (ImportError, SyntaxError):
+    ring_update = None
+
+def counts_to_wind(counts):
+    # Convert to m/s, wind = ((val / 65535 * 3.3) - 0.4) * 32.4 / 1.6
+    return counts / 980.7 - 8.1
+
+class RawWindSensor:
+    # Allocation free sampling. Raw ADC counts are kept in a preallocated
+    # ring buffer of avg_size samples with an integer running sum, giving
+    # a sliding mean for the gust. Conversion to m/s is only done when
+    # values are read.
+    extended = False
+
+    def __init__(self, pin, avg_size):
+        self.adc = machine.ADC(pin)
+
+        self.avg_size = avg_size
+        self.ring = array('H', bytes(2 * avg_size))
+        self.ring_pos = 0
+        self.ring_count = 0
+        self.ring_sum = 0
+
+        # Minute sum and count, max ring sum
+        self.acc = 0
+        self.acc_count = 0
+        self.gust = 0
+
+    def accumulate(self):
+        val = self.adc.read_u16()
+
+        pos = self.ring_pos
+        if ring_update:
+            self.ring_sum += ring_update(self.ring, pos, val)
+        else:
+            self.ring_sum += val - self.ring[pos]
+            self.ring[pos] = val
+
+        pos += 1
+        self.ring_pos = 0 if pos == self.avg_size else pos
+
+        self.acc += val
+        self.acc_count += 1
+
+        # Gust only once the ring is full
+        if self.ring_count < self.avg_size:
+            self.ring_count += 1
+        if self.ring_count == self.avg_size and self.ring_sum > self.gust:
+            self.gust = self.ring_sum
+
+    def values(self):
+        if self.acc_count == 0:
+            wind = 0
+            gust = 0
+        else:
+            wind = counts_to_wind(self.acc / self.acc_count)
+            gust = counts_to_wind(self.gust / self.avg_size) if self.gust else wind
+
+        return wind, gust
+
+    def result(self):
+        wind, gust = self.values()
+
+        # Ring buffer carries on into the next measurement
+        self.acc = 0
+        self.acc_count = 0
+        self.gust = 0
+
+        return wind, gust
+
+class HighRateWindSensor:
+    # High rate sampling (rate Hz) with WMO style gusts. A ring buffer of
+    # gust_secs of raw counts holds two running sums, a 1 second sliding
+    # mean for the existing gust value and a gust_secs sliding mean for
+    # the standard gust. Standard deviation uses 12 bit counts, with
+    # integer sums of squares folded into a float once a second so
+    # per-sample arithmetic stays in small ints.
+    #
+    # result() returns (wind, gust, gust3, wind_sd)
+    extended = True
+
+    def __init__(self, pin, rate, gust_secs=3):
+        self.adc = machine.ADC(pin)
+
+        self.rate = rate
+        self.size = rate * gust_secs
+        self.ring = array('H', bytes(2 * self.size))
+        self.ring_pos = 0
+        self.ring_count = 0
+        self.sum_short = 0
+        self.sum_long = 0
+
+        self.acc = 0
+        self.acc_count = 0
+        self.gust_short = 0
+        self.gust_long = 0
+
+        # Sum of 12 bit counts, per second and per minute sums of their
+        # squares
+        self.sum12 = 0
+        self.sec_sq = 0
+        self.sec_count = 0
+        self.sq_acc = 0.0
+
+    def accumulate(self):
+        val = self.adc.read_u16()
+
+        ring = self.ring
+        pos = self.ring_pos
+
+        # Sample leaving the 1 second window
+        short_pos = pos - self.rate
+        if short_pos < 0:
+            short_pos += self.size
+
+        self.sum_short += val - ring[short_pos]
+        self.sum_long += val - ring[pos]
+        ring[pos] = val
+
+        pos += 1
+        self.ring_pos = 0 if pos == self.size else pos
+
+        self.acc += val
+        self.acc_count += 1
+
+        v = val >> 4
+        self.sum12 += v
+        self.sec_sq += v * v
+        self.sec_count += 1
+        if self.sec_count == self.rate:
+            self.sq_acc += self.sec_sq
+            self.sec_sq = 0
+            self.sec_count = 0
+
+        if self.ring_count < self.size:
+            self.ring_count += 1
+        if self.ring_count >= self.rate and self.sum_short > self.gust_short:
+            self.gust_short = self.sum_short
+        if self.ring_count == self.size and self.sum_long > self.gust_long:
+            self.gust_long = self.sum_long
+
+    def values(self):
+        n = self.acc_count
+        if n == 0:
+            return 0, 0, 0, 0
+
+        mean = self.acc / n
+        wind = counts_to_wind(mean)
+        gust = counts_to_wind(self.gust_short / self.rate) if self.gust_short else wind
+        gust3 = counts_to_wind(self.gust_long / self.size) if self.gust_long else gust
+
+        # Variance in 12 bit counts, scaled back to 16 bit then m/s. The
+        # mean is of the same truncated counts as the squares, mean / 16
+        # would bias the variance by the dropped low bits
+        mean12 = self.sum12 / n
+        var = (self.sq_acc + self.sec_sq) / n - mean12 * mean12
+        sd = (var ** 0.5) * 16 / 980.7 if var > 0 else 0
+
+        return wind, gust, gust3, sd
+
+    def result(self):
+        values = self.values()
+
+        self.acc = 0
+        self.acc_count = 0
+        self.gust_short = 0
+        self.gust_long = 0
+        self.sum12 = 0
+        self.sec_sq = 0
+        self.sec_count = 0
+        self.sq_acc = 0.0
+
+        return values
+
 #----------------------------------------------------------------------
 # Temperature sensor
 
 class TemperatureSensor:
+    # All probes are converted together with one bus-wide convert_temp(),
+    # then read one per tick by read_next() once the conversion is done so
+    # the timer callback is never held up by several reads
     def __init__(self, ow_pin, fan_pin):
         ow = OneWire(ow_pin)
         self.ds_sensor = DS18X20(ow)
@@ -129,55 +390,72 @@ class TemperatureSensor:
         self.fan_pin = fan_pin
         self.fan_value = 'off'
 
-        self.acc = 0
-        self.acc_count = 0
+        self.acc = []
+        self.acc_count = []
+        self.read_pos = 0
 
     def scan(self):
-        self.roms = self.ds_sensor.scan()
+        self.roms = self.ds_sensor.scan()[:TEMP_MAX_PROBES]
         if self.roms:
             print("Found DS devices:", self.roms)
-            self.convert = False
         else:
             print("No DS devices found")
 
+        self.acc = [0.0] * len(self.roms)
+        self.acc_count = [0] * len(self.roms)
+        self.read_pos = len(self.roms)
+
     def accumulate(self):
         if self.roms:
-            if self.convert:
-                try:
-                    t = self.ds_sensor.read_temp(self.roms[0])
-                    print("Temperature:", t)
-
-                    # Accumulate results
-                    self.acc += t
-                    self.acc_count += 1
-
-                except OneWireError:
-                    print("One-wire read error")
+            if self.read_pos < len(self.roms):
+                print("One-wire reads incomplete")
 
             # Start next conversion
             try:
                 self.ds_sensor.convert_temp()
-                self.convert = True
+                self.read_pos = -TEMP_CONVERT_TICKS
             except OneWireError:
                 print("One-wire convert error")
-                self.convert  = False
+                self.read_pos = len(self.roms)
 
-    def value(self):
-        if self.acc_count == 0:
-            val = 0
-        else:
-            val = self.acc / self.acc_count
+    def read_next(self):
+        # Called every 100ms, reads at most one probe
+        pos = self.read_pos
+        if pos >= len(self.roms):
+            return
+
+        self.read_pos = pos + 1
+        if pos < 0:
+            return
+
+        try:
+            t = self.ds_sensor.read_temp(self.roms[pos])
+            print("Temperature:", pos, t)
+
+            # Accumulate results
+            self.acc[pos] += t
+            self.acc_count[pos] += 1
+
+        except OneWireError:
+            print("One-wire read error")
 
-        return val
+    def values(self):
+        return [acc / count if count else 0
+                for acc, count in zip(self.acc, self.acc_count)]
+
+    def value(self):
+        # First probe
+        return self.values()[0] if self.roms else 0
 
     def result(self):
-        # Return average value and reset accumulator
-        val = self.value()
+        # Return per-probe average values and reset accumulators
+        vals = self.values()
 
-        self.acc = 0
-        self.acc_count = 0
+        for i in range(len(vals)):
+            self.acc[i] = 0.0
+            self.acc_count[i] = 0
 
-        return val
+        return vals
 
     def set_fan(self, value):
         if value == 'on':
@@ -191,9 +469,13 @@ class TemperatureSensor:
 # Watchdog
 
 class Watchdog():
-    def __init__(self, wdt, reset_cause):
+    # server_reset resets the board after 10 minutes without a message from
+    # metlog, off for the async MQTT client which reconnects by itself and
+    # keeps results in the store meanwhile
+    def __init__(self, wdt, reset_cause, server_reset=True):
         self.wdt = wdt
         self.reset_cause = reset_cause
+        self.server_reset = server_reset
 
         self.up_count = 0
         self.server_count = 0
@@ -210,21 +492,37 @@ class Watchdog():
 
             # Reset after 10 minutes if no messages received
             self.server_count += 1
-            if self.server_count > 60:
+            if self.server_reset and self.server_count > 60:
                 print("Server watchdog reset")
                 machine.reset()
 
 #----------------------------------------------------------------------
 
 class MetSensor:
-    def __init__(self, temperature_sensor, wind_sensor, led, mqtt, watchdog):
+    # sample_rate is wind sample rate in Hz, a multiple of 10
+    def __init__(self, temperature_sensor, wind_sensor, led, mqtt, watchdog,
+                 sample_rate=10, store=None):
         self.temperature_sensor = temperature_sensor
         self.wind_sensor = wind_sensor
         self.led = led
         self.mqtt = mqtt
         self.watchdog = watchdog
+        self.store = store
+
+        # Timer ticks per 100ms count
+        self.ticks_per_count = sample_rate // 10
+        self.tick = 0
 
         self.count = 0
+        self.results_buf = bytearray(struct.calcsize(RESULTS_FORMAT))
+        self.results_buf_2 = bytearray(struct.calcsize(RESULTS_FORMAT_2))
+
+        # Version 3 for more than one probe, sized for the probes found
+        probes = len(temperature_sensor.roms)
+        if probes > 1:
+            self.results_buf_3 = bytearray(struct.calcsize(RESULTS_FORMAT_3) + 2 * probes)
+        else:
+            self.results_buf_3 = None
 
         # Seconds from midnight GMT
         self.sunrise = 21600
@@ -232,75 +530,160 @@ class MetSensor:
 
     def start(self, timer):
         self.mqtt.set_callback(self.mqtt_callback)
-        self.mqtt.connect()
+        if not MQTT_ASYNC:
+            self.mqtt.connect()
         self.mqtt.subscribe(b"metlog/#")
 
         self.timer_cb_ref = self.timer_cb
-        timer.init(mode=machine.Timer.PERIODIC, period= 100,
+        timer.init(mode=machine.Timer.PERIODIC, period=100 // self.ticks_per_count,
                    callback=self.timer_cb_ref)
 
     def timer_isr(self, t):
         micropython.schedule(self.timer_cb_ref)
 
     def timer_cb(self, arg):
-        self.count += 1
-
-        # Wind accumulates every 100ms
+        # Wind accumulates every tick
         self.wind_sensor.accumulate()
 
+        self.tick += 1
+        if self.tick < self.ticks_per_count:
+            return
+        self.tick = 0
+
+        # Everything else every 100ms
+        self.count += 1
+
         if self.count % 50 == 0:
-            # Temperature accumulates every 5s
+            # Temperature conversion every 5s
             self.temperature_sensor.accumulate()
+        else:
+            self.temperature_sensor.read_next()
 
         # Blink the LED
         self.led.value(0 if self.count % 10 else 1)
 
         # Publish results once a minute
         if self.count == 600:
-            wind, gust = self.wind_sensor.result()
-            results = {'wind': wind,
-                       'gust': gust,
-                       'temp': self.temperature_sensor.result(),
-                       'reset_cause': self.watchdog.reset_cause,
-                       'up_count': self.watchdog.up_count,
-                       'fan': self.temperature_sensor.fan_value}
-
-            print("Publish:", results)
-            self.mqtt.publish(b"metsensor/results",
-                              json.dumps(results).encode('utf-8'))
+            if BINARY_RESULTS:
+                self.publish_binary()
+            else:
+                self.publish_json()
 
             self.count = 0
 
-        # Check for incoming MQTT data
-        self.mqtt.check_msg()
+        # Check for incoming MQTT data, the async client receives in its
+        # own task
+        if not MQTT_ASYNC:
+            self.mqtt.check_msg()
 
         # Watchdog
         if self.count % 100 == 0:
             self.watchdog.feed()
 
+    def publish_json(self):
+        if self.wind_sensor.extended:
+            wind, gust, gust3, wind_sd = self.wind_sensor.result()
+        else:
+            wind, gust = self.wind_sensor.result()
+
+        temps = self.temperature_sensor.result()
+        results = {'wind': wind,
+                   'gust': gust,
+                   'temp': temps[0] if temps else 0,
+                   'reset_cause': self.watchdog.reset_cause,
+                   'up_count': self.watchdog.up_count,
+                   'fan': self.temperature_sensor.fan_value}
+
+        if self.wind_sensor.extended:
+            results['gust3'] = gust3
+            results['wind_sd'] = wind_sd
+
+        if len(temps) > 1:
+            results['temps'] = temps
+
+        print("Publish:", results)
+        self.mqtt.publish(b"metsensor/results",
+                          json.dumps(results).encode('utf-8'))
+
+    def publish_binary(self):
+        # Fixed point values packed into a preallocated buffer
+        temps = self.temperature_sensor.result()
+        temp = temps[0] if temps else 0
+        flags = RESULTS_FLAG_FAN if self.temperature_sensor.fan_value == 'on' else 0
+
+        if self.results_buf_3 is not None:
+            if self.wind_sensor.extended:
+                wind, gust, gust3, wind_sd = self.wind_sensor.result()
+                gust3 = round(gust3 * 100)
+                wind_sd = round(wind_sd * 100)
+            else:
+                wind, gust = self.wind_sensor.result()
+                gust3 = RESULTS_NONE
+                wind_sd = RESULTS_NONE
+
+            buf = self.results_buf_3
+            struct.pack_into(RESULTS_FORMAT_3, buf, 0,
+                             RESULTS_VERSION_3, flags, self.watchdog.reset_cause,
+                             round(wind * 100), round(gust * 100), round(temp * 100),
+                             self.watchdog.up_count, gust3, wind_sd, len(temps))
+            pos = struct.calcsize(RESULTS_FORMAT_3)
+            for t in temps:
+                struct.pack_into("<h", buf, pos, round(t * 100))
+                pos += 2
+
+        elif self.wind_sensor.extended:
+            wind, gust, gust3, wind_sd = self.wind_sensor.result()
+            buf = self.results_buf_2
+            struct.pack_into(RESULTS_FORMAT_2, buf, 0,
+                             RESULTS_VERSION_2, flags, self.watchdog.reset_cause,
+                             round(wind * 100), round(gust * 100), round(temp * 100),
+                             self.watchdog.up_count,
+                             round(gust3 * 100), round(wind_sd * 100))
+        else:
+            wind, gust = self.wind_sensor.result()
+            buf = self.results_buf
+            struct.pack_into(RESULTS_FORMAT, buf, 0,
+                             RESULTS_VERSION, flags, self.watchdog.reset_cause,
+                             round(wind * 100), round(gust * 100), round(temp * 100),
+                             self.watchdog.up_count)
+
+        # Store while disconnected or a backlog is waiting, so results
+        # are replayed in order
+        if self.store is not None and (not self.mqtt.connected or self.store.backlog()):
+            print("Store:", wind, gust, temp)
+            self.store.add(time.time(), buf)
+            return
+
+        print("Publish:", wind, gust, temp)
+        self.mqtt.publish(b"metsensor/results", buf)
+
     def mqtt_callback(self, topic, msg):
+        # topic and msg may be memoryviews into the MQTT receive buffer
         self.watchdog.server_feed()
 
-        parts = topic.split(b'/')
-        if len(parts) != 2:
+        if not bytes_at(topic, 0, CONTROL_PREFIX):
             return
 
         try:
-            if parts[1] == b'sunrise':
-                self.sunrise = int(msg)
+            if is_control(topic, b'sunrise'):
+                self.sunrise = parse_int(msg)
 
-            elif parts[1] == b'sunset':
-                self.sunset = int(msg)
+            elif is_control(topic, b'sunset'):
+                self.sunset = parse_int(msg)
 
-            elif parts[1] == b'time':
-                tim = int(msg)
+            elif is_control(topic, b'time'):
+                tim = parse_int(msg)
 
                 if tim >= self.sunrise and tim < self.sunset:
                     self.temperature_sensor.set_fan('on')
                 else:
                     self.temperature_sensor.set_fan('off')
 
-            elif parts[1] == b'repl':
+            elif is_control(topic, b'batch_ack'):
+                if self.store is not None:
+                    self.store.ack(parse_int(msg))
+
+            elif is_control(topic, b'repl'):
                 # Restart board without running program to allow WebREPL
                 f = open(NOSTART_FILE, "w")
                 f.close()
@@ -308,20 +691,34 @@ class MetSensor:
                 machine.reset()
 
         except ValueError:
-            print("ValueError:", topic, msg)
+            print("ValueError:", bytes(topic), bytes(msg))
 
 #----------------------------------------------------------------------
 
+async def run_async(mqtt, store):
+    if store is not None:
+        asyncio.create_task(store.run(mqtt))
+
+    await mqtt.run()
+
 def pymet(wdt):
     # Get result cause
     reset_cause = machine.reset_cause()
     print("Reset cause:", reset_cause)
 
-    watchdog = Watchdog(wdt, reset_cause)
+    watchdog = Watchdog(wdt, reset_cause, not MQTT_ASYNC)
 
     # Initialise sensors
     wind_pin = machine.Pin(WIND_ADC_PIN)
-    wind_sensor = WindSensor(wind_pin, 10)
+    if WIND_HIGH_RATE:
+        sample_rate = WIND_SAMPLE_RATE
+        wind_sensor = HighRateWindSensor(wind_pin, sample_rate)
+    else:
+        sample_rate = 10
+        if WIND_RAW_SAMPLING:
+            wind_sensor = RawWindSensor(wind_pin, 10)
+        else:
+            wind_sensor = WindSensor(wind_pin, 10)
 
     ow_pin = machine.Pin(TEMP_ONEWIRE_PIN)
     fan_pin = machine.Pin(TEMP_FAN_PIN, machine.Pin.OUT)
@@ -330,18 +727,29 @@ def pymet(wdt):
 
     # Create sensor task
     sensor_led = Led(BLUE_LED_PIN)
-    mqtt = MQTTClient("metsensor", MQTT_SERVER)
+    if MQTT_ASYNC:
+        mqtt = AsyncMQTTClient(b"metsensor", MQTT_SERVER)
+    else:
+        mqtt = MQTTClient(b"metsensor", MQTT_SERVER)
+
+    if MQTT_ASYNC and BINARY_RESULTS and RESULTS_STORE:
+        store = ResultStore(RESULTS_STORE_DIR)
+    else:
+        store = None
 
     metsensor = MetSensor(temperature_sensor, wind_sensor, sensor_led,
-                          mqtt, watchdog)
+                          mqtt, watchdog, sample_rate, store)
 
     timer = machine.Timer(-1)
     metsensor.start(timer)
 
     print("Press CTRL-C to exit...")
     try:
-        while 1:
-            time.sleep(1)
+        if MQTT_ASYNC:
+            asyncio.run(run_async(mqtt, store))
+        else:
+            while 1:
+                time.sleep(1)
     except KeyboardInterrupt:
         timer.deinit()
 
@@ -0,0 +1,210 @@
+import uasyncio as asyncio
+import uos as os
+import ustruct as struct
+import utime as time
+
+# Record is the sensor time (seconds) followed by a results payload zero
+# padded to RESULT_SIZE, the largest results format (version 3 with four
+# probes)
+RESULT_SIZE = 26
+RECORD_SIZE = 4 + RESULT_SIZE
+
+# Record size of the pages in the store directory
+SIZE_FILE = "size"
+
+# Records per page file and most pages kept, 64 pages of minute results
+# is about 68 hours
+PAGE_RECORDS = 64
+MAX_PAGES = 64
+
+# Records waiting in RAM to be written to flash, a ring written by add()
+# and read by flush()
+PENDING_SIZE = 8
+
+# Batch payload, see metlog/payload.py
+BATCH_VERSION = 1
+BATCH_HEADER = "<BBI"
+BATCH_RECORDS = 16
+
+BATCH_TOPIC = b"metsensor/batch"
+
+# Time between batches while replaying (seconds)
+REPLAY_INTERVAL = 0.2
+
+# A batch not acknowledged by the host in this time is sent again (seconds)
+ACK_TIMEOUT = 10
+
+class ResultStore:
+    """
+    Flash store-and-forward buffer for results that couldn't be sent.
+    add() is called from the timer callback and only copies the record
+    into RAM, run() appends records to page files in path within a
+    second, so they survive a reset, and replays the backlog as batches
+    once the MQTT client is connected. One batch is sent at a time and
+    its records are kept until the host acknowledges it with ack(). Page
+    files are only appended to and are deleted once acknowledged, but on
+    FAT each append also rewrites the FAT and directory sectors, so
+    results only reach flash while disconnected or replaying. When the
+    store is full the oldest page is dropped.
+    """
+    def __init__(self, path, page_records=PAGE_RECORDS, max_pages=MAX_PAGES):
+        self.path = path
+        self.page_records = page_records
+        self.max_pages = max_pages
+
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass
+
+        self.check_size()
+
+        # Pages left from before a reset
+        self.pages = sorted(int(name) for name in os.listdir(path) if name != SIZE_FILE)
+        if self.pages:
+            self.last_count = os.stat(self.page_file(self.pages[-1]))[6] // RECORD_SIZE
+        else:
+            self.last_count = 0
+
+        # Records of the first page acknowledged, then records, sensor
+        # time and ticks_ms of the batch waiting for an ack
+        self.sent = 0
+        self.inflight = 0
+        self.inflight_time = 0
+        self.inflight_ticks = 0
+
+        # Records added and records flushed, only add() moves head and
+        # only flush() moves tail
+        self.pending = bytearray(PENDING_SIZE * RECORD_SIZE)
+        self.head = 0
+        self.tail = 0
+
+        self.header_size = struct.calcsize(BATCH_HEADER)
+        self.batch = bytearray(self.header_size + BATCH_RECORDS * RECORD_SIZE)
+
+        if self.pages:
+            print("Result store backlog:", self.backlog())
+
+    def check_size(self):
+        # Pages written with another record size can't be replayed
+        size_file = "%s/%s" % (self.path, SIZE_FILE)
+        try:
+            with open(size_file) as f:
+                size = int(f.read())
+        except (OSError, ValueError):
+            size = None
+
+        if size != RECORD_SIZE:
+            for name in os.listdir(self.path):
+                os.remove("%s/%s" % (self.path, name))
+            with open(size_file, "w") as f:
+                f.write(str(RECORD_SIZE))
+
+    def page_file(self, page):
+        return "%s/%d" % (self.path, page)
+
+    def page_count(self, i):
+        # Only the last page is still being appended to
+        return self.last_count if i == len(self.pages) - 1 else self.page_records
+
+    def backlog(self):
+        n = self.head - self.tail - self.sent
+        for i in range(len(self.pages)):
+            n += self.page_count(i)
+        return n
+
+    def add(self, t, result):
+        if self.head - self.tail == PENDING_SIZE:
+            # Flash writes have stalled
+            print("Result store pending full, dropping result")
+            return
+
+        pos = (self.head % PENDING_SIZE) * RECORD_SIZE
+        struct.pack_into("<I", self.pending, pos, t)
+        pos += 4
+        n = len(result)
+        self.pending[pos:pos + n] = result
+        for i in range(pos + n, pos + RESULT_SIZE):
+            self.pending[i] = 0
+
+        self.head += 1
+
+    def flush(self):
+        # add() may run from the timer callback between statements here,
+        # records it adds are left for the next flush
+        head = self.head
+        pending = memoryview(self.pending)
+        while self.tail != head:
+            if not self.pages or self.last_count == self.page_records:
+                self.new_page()
+
+            start = self.tail % PENDING_SIZE
+            n = min(head - self.tail, PENDING_SIZE - start,
+                    self.page_records - self.last_count)
+            with open(self.page_file(self.pages[-1]), "ab") as f:
+                f.write(pending[start * RECORD_SIZE:(start + n) * RECORD_SIZE])
+
+            self.last_count += n
+            self.tail += n
+
+    def new_page(self):
+        if len(self.pages) == self.max_pages:
+            print("Result store full, dropping oldest page")
+            self.remove_page()
+
+        self.pages.append(self.pages[-1] + 1 if self.pages else 0)
+        self.last_count = 0
+
+    def remove_page(self):
+        os.remove(self.page_file(self.pages.pop(0)))
+        self.sent = 0
+        self.inflight = 0
+        if not self.pages:
+            self.last_count = 0
+
+    def replay(self, mqtt):
+        # Publish the next batch from the first page
+        count = self.page_count(0)
+        n = min(count - self.sent, BATCH_RECORDS)
+
+        if n > 0:
+            size = self.header_size + n * RECORD_SIZE
+            batch = memoryview(self.batch)
+            with open(self.page_file(self.pages[0]), "rb") as f:
+                f.seek(self.sent * RECORD_SIZE)
+                f.readinto(batch[self.header_size:size])
+
+            t = time.time()
+            struct.pack_into(BATCH_HEADER, self.batch, 0, BATCH_VERSION, RECORD_SIZE, t)
+
+            # Set first in case the ack arrives during publish()
+            self.inflight = n
+            self.inflight_time = t
+            self.inflight_ticks = time.ticks_ms()
+            mqtt.publish(BATCH_TOPIC, bytes(batch[:size]))
+
+        elif self.sent >= count:
+            self.remove_page()
+
+    def ack(self, t):
+        # Host has committed the batch sent at sensor time t
+        if not self.inflight or t != self.inflight_time:
+            return
+
+        self.sent += self.inflight
+        self.inflight = 0
+        if self.sent >= self.page_count(0):
+            self.remove_page()
+
+    async def run(self, mqtt):
+        while True:
+            if self.head != self.tail:
+                self.flush()
+
+            if self.pages and mqtt.connected and not mqtt.queue:
+                if (not self.inflight or
+                        time.ticks_diff(time.ticks_ms(), self.inflight_ticks) > ACK_TIMEOUT * 1000):
+                    self.replay(mqtt)
+                await asyncio.sleep(REPLAY_INTERVAL)
+            else:
+                await asyncio.sleep(1)
@@ -0,0 +1,11 @@
+import micropython
+
+# Viper ring buffer update for pymet.RawWindSensor. Kept in its own module
+# so pymet still loads on ports without the viper emitter.
+
+@micropython.viper
+def ring_update(ring, pos: int, val: int) -> int:
+    buf = ptr16(ring)
+    old = int(buf[pos])
+    buf[pos] = val
+    return val - old
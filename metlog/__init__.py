@@ -1,2 +1,2 @@
-from .metlog import MqttClient, ask_exit, init_db
+from .metlog import MqttClient, ask_exit, init_db, migrate_db
 from .suntime import Sun
@@ -0,0 +1,127 @@
+"""
+Streaming export of readings to CSV, NDJSON or Parquet. Rows are read
+with fetchmany so memory use doesn't depend on the size of the time
+range. Parquet output needs pyarrow. With --probes the per-probe
+temperatures are exported instead of the readings.
+
+    python -m metlog.export metlog.db output.csv --start 2020-01-01 --end 2021-01-01
+"""
+import csv
+import json
+import sqlite3
+import sys
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+CHUNK_SIZE = 10000
+
+FIELDS = ('ts', 'wind', 'gust', 'temp', 'gust3', 'wind_sd')
+
+PROBE_FIELDS = ('ts', 'probe', 'temp')
+
+def readings(dbc, start, end, station='', chunk_size=CHUNK_SIZE):
+    """
+    Yields chunks of (ts, wind, gust, temp, gust3, wind_sd) rows with
+    start <= ts < end
+    """
+    cur = dbc.execute(
+        "select ts, wind, gust, temp, gust3, wind_sd from metlog "
+        "where station = ? and ts >= ? and ts < ? order by ts",
+        (station, start, end))
+
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+def probes(dbc, start, end, station='', chunk_size=CHUNK_SIZE):
+    """
+    Yields chunks of (ts, probe, temp) rows with start <= ts < end
+    """
+    cur = dbc.execute(
+        "select ts, probe, temp from probes "
+        "where station = ? and ts >= ? and ts < ? order by ts, probe",
+        (station, start, end))
+
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+def export_csv(chunks, f, fields=FIELDS):
+    writer = csv.writer(f)
+    writer.writerow(fields)
+    for rows in chunks:
+        writer.writerows(rows)
+
+def export_ndjson(chunks, f, fields=FIELDS):
+    for rows in chunks:
+        f.writelines(json.dumps(dict(zip(fields, row))) + "\n" for row in rows)
+
+def export_parquet(chunks, filename, fields=FIELDS):
+    if pa is None:
+        raise RuntimeError("Parquet export needs pyarrow")
+
+    # Probe index is an integer, other values single precision
+    types = {'ts': pa.timestamp('s'), 'probe': pa.int16()}
+    schema = pa.schema([(name, types.get(name, pa.float32())) for name in fields])
+
+    # One row group per chunk
+    with pq.ParquetWriter(filename, schema) as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            writer.write_batch(pa.record_batch(
+                [pa.array(columns[0], pa.string()).cast(pa.timestamp('s'))] +
+                [pa.array(col, field.type) for col, field in zip(columns[1:], list(schema)[1:])],
+                schema=schema))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export readings")
+    parser.add_argument("db_file", help="Database file")
+    parser.add_argument("output", help="Output file, - for stdout")
+    parser.add_argument("--start", type=datetime.fromisoformat, default=datetime.min,
+                        help="Start time (ISO format)")
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime.max,
+                        help="End time (ISO format)")
+    parser.add_argument("--station", default="", help="Station id")
+    parser.add_argument("--format", choices=["csv", "ndjson", "parquet"],
+                        help="Output format (default from file extension)")
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE,
+                        help="Rows per fetch and Parquet row group")
+    parser.add_argument("--probes", action="store_true",
+                        help="Export per-probe temperatures")
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None:
+        fmt = {'.parquet': "parquet", '.ndjson': "ndjson",
+               '.jsonl': "ndjson"}.get(args.output[args.output.rfind("."):], "csv")
+
+    dbc = sqlite3.connect(args.db_file)
+    if args.probes:
+        chunks = probes(dbc, args.start, args.end, args.station, args.chunk)
+        fields = PROBE_FIELDS
+    else:
+        chunks = readings(dbc, args.start, args.end, args.station, args.chunk)
+        fields = FIELDS
+
+    if fmt == "parquet":
+        export_parquet(chunks, args.output, fields)
+    else:
+        fn = export_csv if fmt == "csv" else export_ndjson
+        if args.output == "-":
+            fn(chunks, sys.stdout, fields)
+        else:
+            with open(args.output, "w", newline="") as f:
+                fn(chunks, f, fields)
+
+    dbc.close()
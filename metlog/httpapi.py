@@ -0,0 +1,188 @@
+"""
+Local HTTP read API serving current conditions from memory:
+
+    /latest?station=id          Most recent reading
+    /today?station=id           Today's min/max temperature and max gust
+    /recent?station=id&minutes=N  Readings from the last N minutes
+
+Responses are serialised once per station update and carry an ETag, so
+repeated polls are answered from cache (or with 304 Not Modified).
+"""
+import asyncio
+from datetime import timedelta
+import json
+import os
+from urllib.parse import parse_qs, urlsplit
+
+from .station import RECENT_SIZE
+
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request",
+           404: "Not Found", 405: "Method Not Allowed"}
+
+# Connections that take longer than this to send a request line and
+# headers, including idle keep-alive connections, are closed (seconds)
+IDLE_TIMEOUT = 15
+
+# Most header lines accepted in a request
+MAX_HEADERS = 100
+
+# Station update sequence numbers restart with the process, so ETags
+# include a per-process nonce
+ETAG_NONCE = os.urandom(4).hex()
+
+class HttpServer:
+    """
+    Minimal asyncio HTTP/1.1 server for GET requests. Subclasses
+    implement get(path, query) returning (status, content type, body,
+    etag)
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.writers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            # wait_closed() waits for open connections
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def get(self, path, query):
+        return 404, "text/plain", b"Not found\n", None
+
+    async def read_head(self, reader):
+        # Request line and headers, None at end of stream. Raises
+        # ValueError for an over-long line or too many headers.
+        request = await reader.readline()
+        if not request:
+            return None
+
+        headers = {}
+        for n in range(MAX_HEADERS + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if n == MAX_HEADERS:
+                raise ValueError("Too many headers")
+            key, _, value = line.decode('latin-1').partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        return request, headers
+
+    async def respond(self, writer, status, ctype, body, etag=None, keep_alive=False):
+        head = ["HTTP/1.1 %d %s" % (status, REASONS[status]),
+                "Content-Type: " + ctype,
+                "Content-Length: %d" % len(body),
+                "Connection: " + ("keep-alive" if keep_alive else "close")]
+        if etag is not None:
+            head.append("ETag: " + etag)
+
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(self.read_head(reader), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                except (ValueError, asyncio.LimitOverrunError):
+                    await self.respond(writer, 400, "text/plain", b"Bad request\n")
+                    break
+                if head is None:
+                    break
+
+                request, headers = head
+                try:
+                    method, target, version = request.decode('latin-1').split()
+                except ValueError:
+                    status, ctype, body, etag = 400, "text/plain", b"Bad request\n", None
+                    version = "HTTP/1.0"
+                else:
+                    if method != "GET":
+                        status, ctype, body, etag = 405, "text/plain", b"Method not allowed\n", None
+                    else:
+                        url = urlsplit(target)
+                        status, ctype, body, etag = self.get(url.path, parse_qs(url.query))
+
+                if etag is not None and headers.get('if-none-match') == etag:
+                    status, body = 304, b""
+
+                keep_alive = (version == "HTTP/1.1" and
+                              headers.get('connection', "").lower() != "close")
+
+                await self.respond(writer, status, ctype, body, etag, keep_alive)
+
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+class ApiServer(HttpServer):
+    def __init__(self, client, host, port):
+        super().__init__(host, port)
+        self.client = client
+
+    def get(self, path, query):
+        station = self.client.stations.get(query.get('station', [''])[0])
+        if station is None or not station.recent:
+            return super().get(path, query)
+
+        if path == "/recent":
+            try:
+                minutes = max(1, min(int(query.get('minutes', ['60'])[0]), RECENT_SIZE))
+            except ValueError:
+                return 400, "text/plain", b"Bad minutes value\n", None
+        else:
+            minutes = None
+
+        # Serialise once per station update
+        key = (path, minutes)
+        response = station.responses.get(key)
+        if response is None:
+            if path == "/latest":
+                data = reading(station.recent[-1])
+            elif path == "/today":
+                data = {'date': station.last_update.date().isoformat(),
+                        'min_temp': station.min_temp,
+                        'max_temp': station.max_temp,
+                        'max_gust': station.max_gust}
+            elif path == "/recent":
+                data = recent(station, minutes)
+            else:
+                return super().get(path, query)
+
+            response = ('"%s-%d"' % (ETAG_NONCE, station.seq), json.dumps(data).encode())
+            station.responses[key] = response
+
+        etag, body = response
+        return 200, "application/json", body, etag
+
+def reading(r):
+    return {'ts': r[0].isoformat(), 'wind': r[1], 'gust': r[2], 'temp': r[3]}
+
+def recent(station, minutes):
+    # Walk back from the newest reading
+    since = station.recent[-1][0] - timedelta(minutes=minutes)
+    rows = []
+    for r in reversed(station.recent):
+        if r[0] <= since:
+            break
+        rows.append(reading(r))
+
+    rows.reverse()
+    return rows
@@ -0,0 +1,260 @@
+"""
+Bulk import of historical readings from CSV, NDJSON or another metlog
+database. Input is streamed in chunks into a staging table, then merged
+into metlog in one statement with duplicates (same station and
+timestamp) dropped. The metlog index is rebuilt after a merge that adds
+more than REINDEX_FRACTION of the table's rows, and the inserted rows are
+added to every rollup table. Per-probe temperatures from another
+database's probes table are copied for the inserted rows.
+
+Readings moved to the archive by metlog.retention are still counted in
+the rollups, so they must not be imported again. With --archive-dir
+incoming rows are checked against the archive files, otherwise rows
+falling in a rollup bucket that holds archived readings are skipped.
+
+    python -m metlog.importer metlog.db data.csv other.db ...
+
+CSV files need a header row with ts, wind, gust and temp columns and
+optionally station, gust3 and wind_sd columns. NDJSON records use the
+same keys.
+"""
+import csv
+import itertools
+import json
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+from . import retention
+from . import rollup
+from .metlog import migrate_db
+
+CHUNK_SIZE = 10000
+
+# Drop the metlog index for the merge and rebuild it afterwards when
+# importing more than this fraction of the table's size, otherwise it is
+# updated row by row
+REINDEX_FRACTION = 0.5
+
+def parse_ts(ts):
+    # ISO format string or Unix time, returned as naive UTC
+    if isinstance(ts, str):
+        try:
+            ts = float(ts)
+        except ValueError:
+            pass
+
+    if isinstance(ts, (int, float)):
+        return datetime.utcfromtimestamp(ts)
+
+    ts = datetime.fromisoformat(ts)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return ts
+
+def optional_float(value):
+    return float(value) if value not in (None, "") else None
+
+def read_csv(f, station):
+    for rec in csv.DictReader(f):
+        yield (rec.get('station', station), parse_ts(rec['ts']),
+               float(rec['wind']), float(rec['gust']), float(rec['temp']),
+               optional_float(rec.get('gust3')), optional_float(rec.get('wind_sd')))
+
+def read_ndjson(f, station):
+    for line in f:
+        if line.strip():
+            rec = json.loads(line)
+            yield (rec.get('station', station), parse_ts(rec['ts']),
+                   rec['wind'], rec['gust'], rec['temp'],
+                   rec.get('gust3'), rec.get('wind_sd'))
+
+def read_db(db_file, station):
+    dbc = sqlite3.connect(db_file)
+    cols = [r[1] for r in dbc.execute("pragma table_info(metlog)")]
+    station_col = "station" if 'station' in cols else "?"
+
+    # Databases from before high rate sensors have no gust3 or wind_sd
+    extra_cols = ", ".join(col if col in cols else "null" for col in ('gust3', 'wind_sd'))
+
+    cur = dbc.execute("select %s, ts, wind, gust, temp, %s from metlog" % (station_col, extra_cols),
+                      () if 'station' in cols else (station,))
+    while True:
+        rows = cur.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        yield from rows
+
+    dbc.close()
+
+def read_db_probes(db_file):
+    dbc = sqlite3.connect(db_file)
+    tables = [r[0] for r in dbc.execute("select name from sqlite_master where type = 'table'")]
+    if 'probes' in tables:
+        cur = dbc.execute("select station, ts, probe, temp from probes")
+        while True:
+            rows = cur.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            yield from rows
+
+    dbc.close()
+
+def read_probes(filename):
+    # Only metlog databases have per-probe temperatures
+    if filename.endswith(".db"):
+        yield from read_db_probes(filename)
+
+def read_file(filename, station):
+    if filename.endswith(".db"):
+        yield from read_db(filename, station)
+    else:
+        with open(filename, newline="") as f:
+            if filename.endswith(".csv"):
+                yield from read_csv(f, station)
+            else:
+                yield from read_ndjson(f, station)
+
+def stage(dbc, table, rows, chunk_size):
+    # Insert rows into a staging table in chunks, returns number of rows
+    count = 0
+    with dbc:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            dbc.executemany("insert into %s values (%s)" %
+                            (table, ", ".join("?" * len(chunk[0]))), chunk)
+            count += len(chunk)
+
+    return count
+
+def drop_archived(dbc, archive_dir=None):
+    # Remove staged rows that were archived, returns number removed
+    with dbc:
+        if archive_dir is not None:
+            dbc.execute("create temp table archived (station text, ts timestamp)")
+            months = dbc.execute("select distinct station, strftime('%Y-%m-01', ts) "
+                                 "from staging").fetchall()
+            for station, month in months:
+                start = datetime.fromisoformat(month)
+                dbc.executemany("insert into archived values (?, ?)", (
+                    (station, r[0]) for r in retention.read_archive(
+                        archive_dir, start, retention.next_month(start), station)))
+
+            dropped = dbc.execute("delete from staging where (station, ts) in "
+                                  "(select station, ts from archived)").rowcount
+
+        else:
+            # Without the archive, a rollup bucket counting more readings than
+            # metlog holds for it has archived readings. Rows in those buckets
+            # may be duplicates and are skipped.
+            res = rollup.existing(dbc)
+            if not res:
+                return 0
+
+            table = rollup.table_name(res[0])
+            bucket = rollup.BUCKET.format(ts="ts", res=res[0])
+            dbc.execute(
+                "create temp table archived as select station, ts from {table} r "
+                "where (station, ts) in (select distinct station, {bucket} from staging) "
+                "and count > (select count(*) from metlog m where m.station = r.station "
+                "and m.ts >= r.ts and m.ts < datetime(r.ts, '+{res} seconds'))".format(
+                    table=table, bucket=bucket, res=res[0]))
+            dropped = dbc.execute("delete from staging where (station, {bucket}) in "
+                                  "(select station, ts from archived)".format(
+                                      bucket=bucket)).rowcount
+
+        dbc.execute("drop table archived")
+
+    return dropped
+
+def import_rows(dbc, rows, chunk_size=CHUNK_SIZE, probes=(), archive_dir=None):
+    """
+    Import (station, ts, wind, gust, temp, gust3, wind_sd) rows, returns
+    number of rows read and number inserted. (station, ts, probe, temp)
+    probes rows are copied for the inserted readings. Rows already
+    archived by metlog.retention are skipped, see drop_archived()
+    """
+    dbc.execute("create temp table staging (station text, ts timestamp, "
+                "wind float, gust float, temp float, gust3 float, wind_sd float)")
+    dbc.execute("create temp table staging_probes (station text, ts timestamp, "
+                "probe integer, temp float)")
+
+    count = stage(dbc, "staging", rows, chunk_size)
+    stage(dbc, "staging_probes", iter(probes), chunk_size)
+
+    dropped = drop_archived(dbc, archive_dir)
+    if dropped:
+        print("Skipping %d archived rows" % dropped)
+
+    with dbc:
+        # One (station, ts) index probe per staged row
+        dbc.execute("create temp table merged as "
+                    "select station, ts, temp, wind, gust, gust3, wind_sd from staging s "
+                    "where not exists (select 1 from metlog m "
+                    "where m.station = s.station and m.ts = s.ts) "
+                    "group by station, ts")
+
+        # Table size from the largest rowid, counting would scan the index
+        new = dbc.execute("select count(*) from merged").fetchone()[0]
+        size = dbc.execute("select coalesce(max(rowid), 0) from metlog").fetchone()[0]
+        reindex = new > size * REINDEX_FRACTION
+
+        # A large import rebuilds the index once rather than updating it per row
+        if reindex:
+            dbc.execute("drop index if exists metlog_station_ts")
+
+        inserted = dbc.execute("insert into metlog (station, ts, wind, gust, temp, gust3, wind_sd) "
+                               "select station, ts, wind, gust, temp, gust3, wind_sd "
+                               "from merged").rowcount
+
+        if reindex:
+            dbc.execute("create index metlog_station_ts on metlog (station, ts)")
+
+        # Only the new rows, rebuilding would lose archived buckets
+        for res in rollup.existing(dbc):
+            rollup.update(dbc, dbc.execute("select * from merged"), (res,))
+
+        dbc.execute("insert or ignore into probes (station, ts, probe, temp) "
+                    "select station, ts, probe, temp from staging_probes "
+                    "where (station, ts) in (select station, ts from merged)")
+
+    dbc.execute("drop table merged")
+    dbc.execute("drop table staging")
+    dbc.execute("drop table staging_probes")
+
+    return count, inserted
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import readings")
+    parser.add_argument("db_file", help="Database file")
+    parser.add_argument("input", nargs="+",
+                        help="Input files (.csv, .db, otherwise NDJSON)")
+    parser.add_argument("--station", default="",
+                        help="Station id for input without one")
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE,
+                        help="Rows per insert chunk")
+    parser.add_argument("--archive-dir",
+                        help="Retention archive directory, archived rows are skipped")
+    args = parser.parse_args()
+
+    migrate_db(args.db_file)
+
+    dbc = sqlite3.connect(args.db_file)
+    dbc.execute("pragma journal_mode=wal")
+
+    start = time.perf_counter()
+    rows = itertools.chain.from_iterable(read_file(f, args.station) for f in args.input)
+    probes = itertools.chain.from_iterable(read_probes(f) for f in args.input)
+    count, inserted = import_rows(dbc, rows, args.chunk, probes, args.archive_dir)
+    elapsed = time.perf_counter() - start
+
+    dbc.close()
+
+    print("Read %d rows, inserted %d, %d duplicates, %.0f rows/s" %
+          (count, inserted, count - inserted, count / elapsed if elapsed else 0))
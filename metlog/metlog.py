@@ -1,20 +1,79 @@
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import json
-import requests
 import sqlite3
+import struct
 import time
 
 from gmqtt.mqtt.constants import MQTTv311
 
+from . import metrics
+from . import payload as result_payload
+from . import query
+from . import rollup
+from .station import Station
+from .uploader import Uploader
+from .writer import DbWriter
+
 METCLOUD = "http://metcloud.freeflight.org.uk/"
 
-RESULT_COUNT = 5
+# Default batch upload URL, None if the server only accepts per-station
+# PUTs. Set with run.py --metcloud-batch.
+METCLOUD_BATCH = None
+
+# Sliding window lengths (seconds)
+WINDOWS = (120, 300, 600, 3600)
+
+# Window used for the main wind/gust values, time between uploads
+# and allowance for jitter in reading times
+AVERAGE_WINDOW = 300
+UPLOAD_INTERVAL = 300
+UPLOAD_JITTER = 30
+
+# Upload data waiting to be sent to metcloud
+OUTBOX_TABLE = ("create table outbox (id integer primary key, station text, "
+                "ts timestamp, data text)")
+
+# Temperatures from sensors with several probes, probe is the index in
+# the sensor's scan order. Narrow table clustered on the primary key.
+PROBES_TABLE = ("create table probes (station text not null, ts timestamp not null, "
+                "probe integer not null, temp float, "
+                "primary key (station, ts, probe)) without rowid")
+
+def init_db(db_file, rollups=rollup.ROLLUPS):
+    dbc = sqlite3.connect(db_file)
+    dbc.execute("pragma auto_vacuum=incremental")
+    with dbc:
+        dbc.execute("create table metlog (station text not null default '', "
+                    "ts timestamp, wind float, gust float, temp float, "
+                    "gust3 float, wind_sd float)")
+        dbc.execute("create index metlog_station_ts on metlog (station, ts)")
+        dbc.execute(OUTBOX_TABLE)
+        dbc.execute(PROBES_TABLE)
+        rollup.create_tables(dbc, rollups)
+
+    dbc.close()
 
-def init_db(db_file):
+def migrate_db(db_file, rollups=rollup.ROLLUPS):
+    # Bring an existing database up to date
     dbc = sqlite3.connect(db_file)
     with dbc:
-        dbc.execute("create table metlog (ts timestamp, wind float, gust float, temp float)")
+        cols = [r[1] for r in dbc.execute("pragma table_info(metlog)")]
+        if 'station' not in cols:
+            dbc.execute("alter table metlog add column station text not null default ''")
+        for col in ('gust3', 'wind_sd'):
+            if col not in cols:
+                dbc.execute("alter table metlog add column %s float" % col)
+
+        dbc.execute("drop index if exists metlog_ts")
+        dbc.execute("create index if not exists metlog_station_ts on metlog (station, ts)")
+        dbc.execute(OUTBOX_TABLE.replace("create table", "create table if not exists"))
+        dbc.execute(PROBES_TABLE.replace("create table", "create table if not exists"))
+
+        # Populate any new rollup tables from existing data
+        created = rollup.create_tables(dbc, rollups)
+        if created:
+            rollup.rebuild(dbc, created)
 
     dbc.close()
 
@@ -23,90 +82,235 @@ def ask_exit(*args):
     STOP.set()
 
 class MqttClient:
-    def __init__(self, mqtt, db_file, sun):
+    def __init__(self, mqtt, db_file, sun, windows=WINDOWS, rollups=rollup.ROLLUPS,
+                 metcloud_batch=METCLOUD_BATCH):
         self.mqtt = mqtt
         self.db_file = db_file
         self.sun = sun
+        self.windows = sorted(set(windows) | {AVERAGE_WINDOW})
 
-        self.last_update = datetime.utcnow()
-        self.update_count = 0
-        self.reset_min_max()
+        self.writer = DbWriter(db_file, rollups=rollups)
+        self.uploader = Uploader(db_file, METCLOUD, metcloud_batch)
+
+        # Event loop, set by main() for callbacks from the writer thread
+        self.loop = None
 
-        self.wind_sum = 0
-        self.gust = 0
+        self.stations = {}
+
+        # Control topic callbacks, called with the message payload
+        self.controls = {}
+
+        self.last_update = datetime.utcnow()
+        self.time_secs = None
 
         self.sunrise = 0
         self.sunset = 0
 
+        metrics.DB_QUEUE.set_function(self.writer.queue.qsize)
+        metrics.UPLOAD_QUEUE.set_function(lambda: self.uploader.backlog)
+
         mqtt.on_connect = self.on_connect
         mqtt.on_message = self.on_message
 
-    def reset_min_max(self):
-        self.min_temp = 100
-        self.max_temp = -100
-        self.max_gust = 0
+    def get_station(self, name, ts):
+        station = self.stations.get(name)
+        if station is None:
+            station = Station(name, ts, self.windows)
+            self.stations[name] = station
 
-    def on_connect(self, client, flags, rc, properties):
-        client.subscribe('metsensor/results')
-        self.publish_suntimes()
+        return station
 
-    def on_message(self, client, topic, payload, qos, properties):
-        result = json.loads(payload)
+    def restore(self):
+        # Restore today's min/max and the wind windows from the database
+        now = datetime.utcnow()
+        today = datetime(now.year, now.month, now.day)
+        since = now - timedelta(seconds=max(self.windows))
 
-        ts = datetime.utcfromtimestamp(round(time.time()))
-        temp = result.get('temp', 0)
-        wind = result.get('wind', 0)
-        gust = result.get('gust', 0)
+        dbc = query.connect(self.db_file)
+
+        for name in query.stations(dbc):
+            for row in query.readings_between(dbc, since, now, name):
+                ts, wind, gust, temp = row[:4]
+                station = self.get_station(name, ts)
+                station.last_update = ts
+                station.add_reading(ts.replace(tzinfo=timezone.utc).timestamp(),
+                                    ts, wind, gust, temp)
+
+            # Today's extremes, from the daily rollup if there is one
+            row = query.extremes(dbc, today, name)
+            if row is not None:
+                station = self.get_station(name, today)
+                station.min_temp, station.max_temp, station.max_gust = row
 
-        # Update database
-        dbc = sqlite3.connect(self.db_file)
-        with dbc:
-            dbc.execute("insert into metlog (ts, temp, wind, gust) values (?, ?, ?, ?)",
-                        (ts, temp, wind, gust))
         dbc.close()
 
-        self.update_server(ts, temp, wind, gust)
+    def add_control(self, topic, callback):
+        self.controls[topic] = callback
 
-    def update_server(self, ts, temp, wind, gust):
-        # Update min/max
-        if ts.day != self.last_update.day:
-            # Reset at start of new day
-            self.reset_min_max()
+    def on_connect(self, client, flags, rc, properties):
+        # Single station sensors publish without a station id
+        client.subscribe('metsensor/results')
+        client.subscribe('metsensor/+/results')
 
-            self.publish_suntimes()
+        # Results stored by the sensor while the broker was unreachable
+        client.subscribe('metsensor/batch')
+        client.subscribe('metsensor/+/batch')
 
-        self.last_update = ts
+        for topic in self.controls:
+            client.subscribe(topic)
+
+        self.publish_suntimes()
 
-        self.min_temp = min(self.min_temp, temp)
-        self.max_temp = max(self.max_temp, temp)
-        self.max_gust = max(self.max_gust, gust)
+    def on_message(self, client, topic, payload, qos, properties):
+        if topic in self.controls:
+            self.controls[topic](payload)
+            return
+
+        t = time.perf_counter()
+        metrics.MESSAGES.inc()
 
-        # Short term averaging
-        self.wind_sum += wind
-        self.gust = max(gust, self.gust)
+        parts = topic.split('/')
+        name = parts[1] if len(parts) == 3 else ''
 
-        self.update_count += 1
-        if self.update_count == RESULT_COUNT:
-            try:
-                data = {'temp': temp,
-                        'wind': self.wind_sum / RESULT_COUNT,
-                        'gust': self.gust,
-                        'min_temp': self.min_temp,
-                        'max_temp': self.max_temp,
-                        'max_gust': self.max_gust}
-                requests.put(METCLOUD, json=data)
+        if parts[-1] == 'batch':
+            self.on_batch(topic, name, payload)
+            metrics.MESSAGE_SECONDS.observe(time.perf_counter() - t)
+            return
 
-            except requests.RequestException as e:
-                print(str(e))
+        try:
+            wind, gust, temp, gust3, wind_sd, temps = result_payload.decode(payload)
+        except (ValueError, struct.error) as e:
+            metrics.MESSAGE_ERRORS.inc()
+            print("Bad payload on %s: %s" % (topic, str(e)))
+            return
 
-            self.update_count = 0
-            self.wind_sum = 0
-            self.gust = 0
+        ts = datetime.utcfromtimestamp(round(time.time()))
 
+        # Update database
+        self.writer.insert(name, ts, temp, wind, gust, gust3, wind_sd, temps)
+
+        self.update_server(self.get_station(name, ts), ts, temp, wind, gust,
+                           gust3, wind_sd, temps)
+
+        metrics.MESSAGE_SECONDS.observe(time.perf_counter() - t)
+
+    def on_batch(self, topic, name, payload):
+        # Stored results replayed by the sensor, only added to the database.
+        # The sensor keeps them until the batch is acknowledged.
+        try:
+            sent, records = result_payload.decode_batch(payload)
+        except (ValueError, struct.error) as e:
+            metrics.MESSAGE_ERRORS.inc()
+            print("Bad batch on %s: %s" % (topic, str(e)))
+            return
+
+        now = time.time()
+        rows = []
+        for age, (wind, gust, temp, gust3, wind_sd, temps) in records:
+            if age < 0:
+                continue
+            ts = datetime.utcfromtimestamp(round(now - age))
+            rows.append((ts, temp, wind, gust, gust3, wind_sd, temps))
+
+        if len(rows) < len(records):
+            # Stored before a sensor clock reset, when isn't known
+            metrics.MESSAGE_ERRORS.inc()
+            print("Dropping %d records from %s stored before a sensor clock reset" %
+                  (len(records) - len(rows), topic))
+
+        # Readings from today missed by the live updates
+        today = datetime.utcfromtimestamp(round(now))
+        station = self.get_station(name, today)
+        for ts, temp, wind, gust, _, _, _ in rows:
+            if ts.date() != today.date():
+                continue
+            if station.last_update.date() != today.date():
+                # First reading of the day
+                station.reset_min_max()
+                station.last_update = ts
+            station.add_extremes(temp, gust)
+
+        if rows:
+            self.writer.insert_many(name, rows, lambda: self.loop.call_soon_threadsafe(
+                self.ack_batch, name, sent))
+        else:
+            self.ack_batch(name, sent)
+
+    def ack_batch(self, name, sent):
+        topic = "metlog/batch_ack" if not name else "metlog/%s/batch_ack" % name
+        self.mqtt.publish(topic, str(sent))
+
+    def update_server(self, station, ts, temp, wind, gust, gust3=None, wind_sd=None,
+                      temps=None):
+        if ts.day != self.last_update.day:
+            self.publish_suntimes()
+        self.last_update = ts
+
+        # Update min/max
+        if ts.day != station.last_update.day:
+            # Reset at start of new day
+            station.reset_min_max()
+        station.last_update = ts
+
+        t = ts.replace(tzinfo=timezone.utc).timestamp()
+        station.add_reading(t, ts, wind, gust, temp)
+
+        station.min_temp = min(station.min_temp, temp)
+        station.max_temp = max(station.max_temp, temp)
+        station.max_gust = max(station.max_gust, gust)
+
+        # 3 second gust and turbulence from high rate sensors
+        if gust3 is not None:
+            station.gust3 = max(station.gust3 or 0, gust3)
+            station.wind_sd = wind_sd
+
+        if temps is not None:
+            station.temps = temps
+
+        if station.next_upload is None:
+            station.next_upload = t + UPLOAD_INTERVAL - UPLOAD_JITTER
+
+        elif t >= station.next_upload:
+            window = station.windows[AVERAGE_WINDOW]
+            data = {'temp': temp,
+                    'wind': window.mean_wind(),
+                    'gust': window.max_gust(),
+                    'min_temp': station.min_temp,
+                    'max_temp': station.max_temp,
+                    'max_gust': station.max_gust}
+
+            # Other windows as wind_<secs>, gust_<secs>
+            for length, window in station.windows.items():
+                data['wind_%d' % length] = window.mean_wind()
+                data['gust_%d' % length] = window.max_gust()
+
+            # Highest 3 second gust since the last upload
+            if station.gust3 is not None:
+                data['gust3'] = station.gust3
+                data['wind_sd'] = station.wind_sd
+                station.gust3 = None
+
+            # Latest temperature of each probe
+            if station.temps is not None:
+                data['temps'] = station.temps
+
+            self.writer.outbox(station.name, ts, json.dumps(data))
+
+            station.next_upload += UPLOAD_INTERVAL
+            if station.next_upload <= t:
+                # Resynchronise after a gap in readings
+                station.next_upload = t + UPLOAD_INTERVAL - UPLOAD_JITTER
+
+            # Publish time for sensor fan control with each upload, once
+            # per minute when several stations upload together
             secs = ts.hour * 3600 + ts.minute * 60
-            self.mqtt.publish("metlog/time", str(secs))
+            if secs != self.time_secs:
+                self.time_secs = secs
+                self.mqtt.publish("metlog/time", str(secs))
 
     def publish_suntimes(self):
+        t = time.perf_counter()
+
         sunrise = self.sun.get_sunrise_time()
         sunset = self.sun.get_sunset_time()
 
@@ -121,8 +325,20 @@ class MqttClient:
         self.mqtt.publish("metlog/sunrise", str(sunrise_secs), qos=1, retain=True)
         self.mqtt.publish("metlog/sunset", str(sunset_secs), qos=1, retain=True)
 
+        metrics.SUNTIMES_SECONDS.observe(time.perf_counter() - t)
+
     async def main(self, broker_host):
+        self.restore()
+
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.writer.on_outbox = lambda: loop.call_soon_threadsafe(self.uploader.notify)
+
+        self.writer.start()
+        self.uploader.start()
         await self.mqtt.connect(broker_host, version=MQTTv311)
 
         await STOP.wait()
         await self.mqtt.disconnect()
+        await self.uploader.stop()
+        self.writer.stop()
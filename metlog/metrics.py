@@ -0,0 +1,115 @@
+"""
+Process metrics in Prometheus text format. Metrics are module level
+objects updated in place, histograms have fixed buckets so recording a
+value is a bisect and a couple of increments.
+"""
+from bisect import bisect_left
+import time
+
+from .httpapi import HttpServer
+
+# Latency buckets (seconds)
+LATENCY_BUCKETS = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01,
+                   0.03, 0.1, 0.3, 1, 3, 10)
+
+METRICS = []
+
+class Counter:
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.value = 0
+        METRICS.append(self)
+
+    def inc(self, n=1):
+        self.value += n
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.doc),
+                "# TYPE %s counter" % self.name,
+                "%s %s" % (self.name, self.value)]
+
+class Gauge:
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.value = 0
+        self.function = None
+        METRICS.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def set_to_current_time(self):
+        self.value = time.time()
+
+    def set_function(self, function):
+        # Value read from function at collection time
+        self.function = function
+
+    def render(self):
+        value = self.value if self.function is None else self.function()
+        return ["# HELP %s %s" % (self.name, self.doc),
+                "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, value)]
+
+class Histogram:
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        METRICS.append(self)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s histogram" % self.name]
+
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{le="%g"} %d' % (self.name, bound, total))
+        total += self.counts[-1]
+
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, total))
+        lines.append("%s_sum %s" % (self.name, self.sum))
+        lines.append("%s_count %d" % (self.name, total))
+        return lines
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode()
+
+MESSAGES = Counter("metlog_messages_total", "MQTT result messages received")
+MESSAGE_ERRORS = Counter("metlog_message_errors_total", "Result messages that could not be decoded")
+MESSAGE_SECONDS = Histogram("metlog_message_seconds", "on_message processing time")
+
+DB_ROWS = Counter("metlog_db_rows_total", "Rows written to the database")
+DB_ERRORS = Counter("metlog_db_errors_total", "Database write errors")
+DB_DROPPED = Counter("metlog_db_dropped_total", "Rows dropped because the write queue was full")
+DB_WRITE_SECONDS = Histogram("metlog_db_write_seconds", "Database group commit time")
+DB_QUEUE = Gauge("metlog_db_queue_depth", "Rows waiting to be written")
+DB_LAST_SUCCESS = Gauge("metlog_db_last_success_timestamp_seconds", "Time of last database commit")
+
+UPLOADS = Counter("metlog_uploads_total", "Metcloud uploads")
+UPLOAD_ERRORS = Counter("metlog_upload_errors_total", "Failed metcloud uploads")
+UPLOAD_DROPPED = Counter("metlog_upload_dropped_total", "Uploads rejected by metcloud and dropped")
+UPLOAD_SECONDS = Histogram("metlog_upload_seconds", "Metcloud request time")
+UPLOAD_QUEUE = Gauge("metlog_upload_queue_depth", "Uploads waiting to be sent")
+UPLOAD_LAST_SUCCESS = Gauge("metlog_upload_last_success_timestamp_seconds", "Time of last successful upload")
+
+SUNTIMES_SECONDS = Histogram("metlog_suntimes_seconds", "publish_suntimes time")
+
+class MetricsServer(HttpServer):
+    def get(self, path, query):
+        if path != "/metrics":
+            return super().get(path, query)
+
+        return 200, "text/plain; version=0.0.4", render(), None
@@ -0,0 +1,150 @@
+"""
+Sensor result payloads. Current firmware sends a fixed layout binary
+record, older devices send JSON.
+
+Binary version 1, little endian:
+
+    B  version (1)
+    B  flags, bit 0 set if fan is on
+    B  reset cause
+    h  wind, 0.01 m/s
+    h  gust, 0.01 m/s
+    h  temperature, 0.01 C
+    I  up count
+
+Version 2 appends:
+
+    h  3 second gust, 0.01 m/s
+    h  wind standard deviation, 0.01 m/s
+
+Version 3 (sensors with more than one temperature probe) is version 2
+with gust3 and wind standard deviation set to NONE if not measured,
+followed by:
+
+    B  probe count
+    h  temperature of each probe, 0.01 C
+
+Batches of stored results (metsensor/batch), little endian:
+
+    B  version (1)
+    B  record size
+    I  sensor clock when sent, seconds
+    records of
+        I  sensor clock when measured, seconds
+        results payload, zero padded to record size
+
+Once a batch is committed the host publishes the sensor clock from its
+header to metlog/batch_ack, the sensor keeps stored results until then.
+"""
+import json
+import struct
+
+VERSION_1 = 1
+STRUCT_1 = struct.Struct("<BBBhhhI")
+
+VERSION_2 = 2
+STRUCT_2 = struct.Struct("<BBBhhhIhh")
+
+VERSION_3 = 3
+STRUCT_3 = struct.Struct("<BBBhhhIhhB")
+NONE = -32768
+
+FLAG_FAN = 0x01
+
+BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct("<BBI")
+RECORD_TIME = struct.Struct("<I")
+
+def encode(wind, gust, temp, reset_cause=0, up_count=0, fan=False,
+           gust3=None, wind_sd=None, temps=None):
+    flags = FLAG_FAN if fan else 0
+    if temps is not None:
+        return STRUCT_3.pack(VERSION_3, flags, reset_cause,
+                             round(wind * 100), round(gust * 100), round(temp * 100),
+                             up_count,
+                             NONE if gust3 is None else round(gust3 * 100),
+                             NONE if wind_sd is None else round(wind_sd * 100),
+                             len(temps)) + \
+            struct.pack("<%dh" % len(temps), *(round(t * 100) for t in temps))
+
+    if gust3 is None:
+        return STRUCT_1.pack(VERSION_1, flags, reset_cause,
+                             round(wind * 100), round(gust * 100), round(temp * 100),
+                             up_count)
+
+    return STRUCT_2.pack(VERSION_2, flags, reset_cause,
+                         round(wind * 100), round(gust * 100), round(temp * 100),
+                         up_count, round(gust3 * 100), round((wind_sd or 0) * 100))
+
+def _value(v):
+    return None if v == NONE else v / 100
+
+def _number(key, v, optional=False):
+    if v is None and optional:
+        return v
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        raise ValueError("Bad %s value %r" % (key, v))
+    return v
+
+def decode(payload):
+    """
+    Returns (wind, gust, temp, gust3, wind_sd, temps) from a binary or
+    JSON payload. gust3 and wind_sd are None if the sensor doesn't send
+    them, temps is a tuple of per-probe temperatures from sensors with
+    more than one probe, otherwise None. Raises ValueError or struct.error
+    for a malformed payload.
+    """
+    if not payload:
+        raise ValueError("Empty payload")
+
+    if payload[0] == VERSION_1:
+        _, _, _, wind, gust, temp, _ = STRUCT_1.unpack_from(payload)
+        return wind / 100, gust / 100, temp / 100, None, None, None
+
+    if payload[0] == VERSION_2:
+        _, _, _, wind, gust, temp, _, gust3, wind_sd = STRUCT_2.unpack_from(payload)
+        return wind / 100, gust / 100, temp / 100, gust3 / 100, wind_sd / 100, None
+
+    if payload[0] == VERSION_3:
+        _, _, _, wind, gust, temp, _, gust3, wind_sd, n = STRUCT_3.unpack_from(payload)
+        temps = struct.unpack_from("<%dh" % n, payload, STRUCT_3.size)
+        return (wind / 100, gust / 100, temp / 100, _value(gust3), _value(wind_sd),
+                tuple(t / 100 for t in temps))
+
+    result = json.loads(payload)
+    if not isinstance(result, dict):
+        raise ValueError("Expected a JSON object")
+
+    temps = result.get('temps')
+    if temps is not None:
+        if not isinstance(temps, list):
+            raise ValueError("Bad temps value %r" % (temps,))
+        temps = tuple(_number('temps', t) for t in temps)
+
+    return (_number('wind', result.get('wind', 0)),
+            _number('gust', result.get('gust', 0)),
+            _number('temp', result.get('temp', 0)),
+            _number('gust3', result.get('gust3'), True),
+            _number('wind_sd', result.get('wind_sd'), True),
+            temps or None)
+
+def decode_batch(payload):
+    """
+    Returns (sent, records) from a batch payload, sent is the sensor clock
+    when the batch was sent and records a list of (age, decode(record)).
+    age is seconds before the batch was sent, negative if the record was
+    stored before the sensor clock was reset.
+    """
+    version, size, now = BATCH_HEADER.unpack_from(payload)
+    if version != BATCH_VERSION or size <= RECORD_TIME.size:
+        raise ValueError("Bad batch version %d size %d" % (version, size))
+
+    records = []
+    for pos in range(BATCH_HEADER.size, len(payload) - size + 1, size):
+        t, = RECORD_TIME.unpack_from(payload, pos)
+        record = payload[pos + RECORD_TIME.size:pos + size]
+        if record[0] not in (VERSION_1, VERSION_2, VERSION_3):
+            raise ValueError("Bad record version %d" % record[0])
+        records.append((now - t, decode(record)))
+
+    return now, records
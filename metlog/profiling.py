@@ -0,0 +1,76 @@
+"""
+On-demand profiling of the running process. toggle() starts a time
+limited cProfile of the event loop thread along with tracemalloc
+tracing, calling it again (or the time limit expiring) stops profiling
+and writes metlog-<time>.prof and metlog-<time>.tracemalloc to the
+output directory. Load them with pstats and tracemalloc.Snapshot.load.
+"""
+import asyncio
+import cProfile
+import os
+import time
+import tracemalloc
+
+# Default profile length (seconds)
+DURATION = 60
+
+class Profiler:
+    def __init__(self, out_dir, duration=DURATION):
+        self.out_dir = out_dir
+        self.duration = duration
+
+        self.profile = None
+        self.timer = None
+        self.tracing = False
+
+    def toggle(self, duration=None):
+        if self.profile is None:
+            self.start(duration or self.duration)
+        else:
+            self.stop()
+
+    def control(self, payload):
+        # MQTT control message, payload is duration in seconds or empty
+        try:
+            self.toggle(int(payload or 0))
+        except ValueError:
+            print("Bad profile duration:", payload)
+
+    def start(self, duration):
+        print("Profiling for %d seconds" % duration)
+
+        # Don't stop tracemalloc if it was already running
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+        self.timer = asyncio.get_running_loop().call_later(duration, self.stop)
+
+    def stop(self):
+        if self.profile is None:
+            return
+
+        self.profile.disable()
+        self.timer.cancel()
+
+        snapshot = tracemalloc.take_snapshot()
+        if self.tracing:
+            tracemalloc.stop()
+
+        # Write files without holding up the event loop
+        profile = self.profile
+        self.profile = None
+        asyncio.get_running_loop().run_in_executor(None, self.write, profile, snapshot)
+
+    def write(self, profile, snapshot):
+        base = os.path.join(self.out_dir, time.strftime("metlog-%Y%m%d-%H%M%S"))
+        try:
+            profile.dump_stats(base + ".prof")
+            snapshot.dump(base + ".tracemalloc")
+            print("Profile written to", base + ".*")
+
+        except OSError as e:
+            print("Error writing profile:", str(e))
@@ -0,0 +1,118 @@
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from . import rollup
+
+def connect(db_file):
+    # Timestamps are returned as datetime objects
+    return sqlite3.connect(db_file, detect_types=sqlite3.PARSE_DECLTYPES)
+
+def readings_between(dbc, start, end, station=''):
+    """
+    Readings with start <= ts < end, in time order, as (ts, wind, gust,
+    temp, gust3, wind_sd). gust3 and wind_sd are None for sensors that
+    don't send them
+    """
+    return dbc.execute(
+        "select ts, wind, gust, temp, gust3, wind_sd from metlog "
+        "where station = ? and ts >= ? and ts < ? order by ts",
+        (station, start, end)).fetchall()
+
+def latest(dbc, n=1, station=''):
+    """
+    Most recent n readings, in time order, same format as readings_between()
+    """
+    rows = dbc.execute(
+        "select ts, wind, gust, temp, gust3, wind_sd from metlog where station = ? "
+        "order by ts desc limit ?",
+        (station, n)).fetchall()
+    rows.reverse()
+    return rows
+
+def stations(dbc):
+    """
+    Station ids with readings, one (station, ts) index seek per station
+    """
+    return [r[0] for r in dbc.execute(
+        "with recursive s(station) as ("
+        "select min(station) from metlog union all "
+        "select (select min(station) from metlog where station > s.station) "
+        "from s where s.station is not null) "
+        "select station from s where station is not null")]
+
+def extremes(dbc, day, station=''):
+    """
+    (min temp, max temp, max gust) of the day starting at day, or None if
+    there are no readings. Read from the daily rollup table if it exists
+    """
+    table = rollup.table_name(86400)
+    cur = dbc.execute("select 1 from sqlite_master where type='table' and name=?", (table,))
+    if cur.fetchone() is not None:
+        return dbc.execute("select temp_min, temp_max, gust_max from %s "
+                           "where station = ? and ts = ?" % table, (station, day)).fetchone()
+
+    row = dbc.execute("select min(temp), max(temp), max(gust) from metlog "
+                      "where station = ? and ts >= ? and ts < ?",
+                      (station, day, day + timedelta(days=1))).fetchone()
+    return None if row[0] is None else row
+
+def probes_between(dbc, start, end, station=''):
+    """
+    Per-probe temperatures with start <= ts < end, as (ts, probe, temp)
+    in time order
+    """
+    return dbc.execute(
+        "select ts, probe, temp from probes "
+        "where station = ? and ts >= ? and ts < ? order by ts, probe",
+        (station, start, end)).fetchall()
+
+def aggregate(dbc, start, end, bucket, station=''):
+    """
+    Readings with start <= ts < end, aggregated into buckets of the given
+    length in seconds. Returns a list of (bucket start, count, mean wind,
+    max gust, min temp, max temp, mean temp) tuples. Whole buckets are
+    read from a rollup table if one exists for the bucket length, partial
+    buckets at either end of the range from the raw readings, so the
+    result is the same as grouped()
+    """
+    cur = dbc.execute("select 1 from sqlite_master where type='table' and name=?",
+                      (rollup.table_name(bucket),))
+    if cur.fetchone() is None:
+        return grouped(dbc, start, end, bucket, station)
+
+    first = bucket_start(start, bucket, up=True)
+    last = bucket_start(end, bucket)
+    if first >= last:
+        return grouped(dbc, start, end, bucket, station)
+
+    return (grouped(dbc, start, first, bucket, station) +
+            rollups(dbc, first, last, bucket, station) +
+            grouped(dbc, last, end, bucket, station))
+
+def bucket_start(ts, bucket, up=False):
+    # Bucket boundary at or before ts (at or after if up is set)
+    secs = int(ts.replace(tzinfo=timezone.utc).timestamp())
+    n = -(-secs // bucket) if up else secs // bucket
+    return datetime.utcfromtimestamp(n * bucket)
+
+def grouped(dbc, start, end, bucket, station=''):
+    """
+    aggregate() computed from the raw readings
+    """
+    rows = dbc.execute(
+        "select cast(strftime('%s', ts) as integer) / ? as b, count(*), "
+        "avg(wind), max(gust), min(temp), max(temp), avg(temp) from metlog "
+        "where station = ? and ts >= ? and ts < ? group by b order by b",
+        (bucket, station, start, end)).fetchall()
+
+    return [(datetime.utcfromtimestamp(r[0] * bucket),) + r[1:] for r in rows]
+
+def rollups(dbc, start, end, res, station=''):
+    """
+    Rollup buckets with start <= bucket start < end, same format as
+    aggregate()
+    """
+    return dbc.execute(
+        "select ts, count, wind_sum / count, gust_max, temp_min, temp_max, "
+        "temp_sum / count from %s where station = ? and ts >= ? and ts < ? "
+        "order by ts" % rollup.table_name(res), (station, start, end)).fetchall()
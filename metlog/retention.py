@@ -0,0 +1,212 @@
+"""
+Retention manager. Raw readings older than a given age are moved from
+the metlog table into gzipped per-month CSV archive files, and probe
+temperatures from the probes table into separate probes-YYYY-MM files,
+leaving the rollup tables untouched. Rows are deleted and free pages released in
+small steps so the database writer is never held up for long.
+
+    python -m metlog.retention metlog.db archive_dir --days 365
+
+Releasing free pages needs a database created with auto_vacuum set to
+incremental (as init_db does). Older databases can be converted once,
+with the logger stopped, using --convert.
+"""
+import csv
+import gzip
+import io
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from . import query
+
+# Rows deleted per transaction
+DELETE_STEP = 1000
+
+# Pages released per incremental vacuum step
+VACUUM_STEP = 100
+
+# Pause between steps (seconds)
+STEP_DELAY = 0.05
+
+# Time between retention runs (seconds)
+RUN_INTERVAL = 86400
+
+def month_start(ts):
+    return datetime(ts.year, ts.month, 1)
+
+def next_month(ts):
+    return datetime(ts.year + ts.month // 12, ts.month % 12 + 1, 1)
+
+def archive_file(archive_dir, ts, table="metlog"):
+    return os.path.join(archive_dir, "%s-%04d-%02d.csv.gz" % (table, ts.year, ts.month))
+
+class Retention:
+    def __init__(self, db_file, archive_dir, days):
+        self.db_file = db_file
+        self.archive_dir = archive_dir
+        self.days = days
+
+        self.thread = None
+
+    def start(self):
+        # Run periodically in a background thread
+        self.thread = threading.Thread(target=self.run_forever, name="metlog-retention",
+                                       daemon=True)
+        self.thread.start()
+
+    def run_forever(self):
+        while True:
+            try:
+                self.run()
+            except (OSError, sqlite3.Error) as e:
+                print("Retention error:", str(e))
+
+            time.sleep(RUN_INTERVAL)
+
+    def run(self):
+        cutoff = datetime.utcnow() - timedelta(days=self.days)
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        dbc = query.connect(self.db_file)
+
+        # Stations and oldest row of each from the index
+        for station in query.stations(dbc):
+            row = dbc.execute("select min(ts) from metlog where station = ?",
+                              (station,)).fetchall()[0]
+            if row[0] is None:
+                continue
+
+            start = month_start(datetime.fromisoformat(row[0]))
+            while start < cutoff:
+                end = min(next_month(start), cutoff)
+                self.archive(dbc, station, start, end)
+                start = end
+
+        self.vacuum(dbc)
+        dbc.close()
+
+    def archive(self, dbc, station, start, end):
+        self.archive_probes(dbc, station, start, end)
+
+        rows = dbc.execute("select station, ts, wind, gust, temp, gust3, wind_sd from metlog "
+                           "where station = ? and ts >= ? and ts < ? order by ts",
+                           (station, start, end)).fetchall()
+        if not rows:
+            return
+
+        self.write_archive(archive_file(self.archive_dir, start), rows)
+
+        # Delete archived rows a few at a time
+        while True:
+            with dbc:
+                cur = dbc.execute(
+                    "delete from metlog where rowid in (select rowid from metlog "
+                    "where station = ? and ts >= ? and ts < ? limit ?)",
+                    (station, start, end, DELETE_STEP))
+            if cur.rowcount < DELETE_STEP:
+                break
+            time.sleep(STEP_DELAY)
+
+        print("Archived %d rows for %s %s" % (len(rows), station or "-", start.strftime("%Y-%m")))
+
+    def archive_probes(self, dbc, station, start, end):
+        rows = dbc.execute("select station, ts, probe, temp from probes "
+                           "where station = ? and ts >= ? and ts < ? order by ts, probe",
+                           (station, start, end)).fetchall()
+        if not rows:
+            return
+
+        self.write_archive(archive_file(self.archive_dir, start, "probes"), rows)
+
+        # Probes has no rowid, delete by primary key range
+        while True:
+            with dbc:
+                cur = dbc.execute(
+                    "delete from probes where station = ? and ts in (select ts from probes "
+                    "where station = ? and ts >= ? and ts < ? limit ?)",
+                    (station, station, start, end, DELETE_STEP))
+            if cur.rowcount == 0:
+                break
+            time.sleep(STEP_DELAY)
+
+    def write_archive(self, filename, rows):
+        # Each run appends a new gzip member to the month's file
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        with open(filename, "ab") as f:
+            f.write(gzip.compress(buf.getvalue().encode()))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def vacuum(self, dbc):
+        if dbc.execute("pragma auto_vacuum").fetchall()[0][0] != 2:
+            return
+
+        free = dbc.execute("pragma freelist_count").fetchall()[0][0]
+        while free > 0:
+            # executescript runs the pragma to completion, execute only
+            # frees a single page
+            dbc.executescript("pragma incremental_vacuum(%d)" % VACUUM_STEP)
+            time.sleep(STEP_DELAY)
+
+            last_free = free
+            free = dbc.execute("pragma freelist_count").fetchall()[0][0]
+            if free >= last_free:
+                break
+
+def optional_float(value):
+    # Empty CSV field for a missing gust3/wind_sd
+    return float(value) if value else None
+
+def read_archive(archive_dir, start, end, station=''):
+    """
+    Archived readings with start <= ts < end, unsorted. Same format as
+    query.readings_between, files written before gust3 and wind_sd were
+    archived give None for both
+    """
+    month = month_start(start)
+    while month < end:
+        filename = archive_file(archive_dir, month)
+        if os.path.exists(filename):
+            with gzip.open(filename, "rt", newline="") as f:
+                for rec in csv.reader(f):
+                    if rec[0] == station:
+                        ts = datetime.fromisoformat(rec[1])
+                        if start <= ts < end:
+                            rec += [""] * (7 - len(rec))
+                            yield (ts, float(rec[2]), float(rec[3]), float(rec[4]),
+                                   optional_float(rec[5]), optional_float(rec[6]))
+
+        month = next_month(month)
+
+def readings_between(dbc, archive_dir, start, end, station=''):
+    """
+    As query.readings_between, including archived readings
+    """
+    rows = {r[0]: r for r in read_archive(archive_dir, start, end, station)}
+    rows.update((r[0], r) for r in query.readings_between(dbc, start, end, station))
+
+    return sorted(rows.values())
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Archive old readings")
+    parser.add_argument("db_file", help="Database file")
+    parser.add_argument("archive_dir", help="Archive directory")
+    parser.add_argument("--days", type=int, default=365,
+                        help="Age of readings to archive (days)")
+    parser.add_argument("--convert", action="store_true",
+                        help="Enable incremental vacuum on an existing database")
+    args = parser.parse_args()
+
+    if args.convert:
+        dbc = sqlite3.connect(args.db_file)
+        dbc.execute("pragma auto_vacuum=incremental")
+        dbc.execute("vacuum")
+        dbc.close()
+
+    Retention(args.db_file, args.archive_dir, args.days).run()
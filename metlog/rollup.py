@@ -0,0 +1,97 @@
+"""
+Rollup tables holding per-bucket aggregates of the metlog table, one
+table per resolution (in seconds). Buckets are updated as each reading
+is inserted and can be rebuilt in bulk from the raw data. Rollups outlive
+the raw readings archived by metlog.retention, so a rebuild only replaces
+buckets from the oldest live reading onwards.
+"""
+import sqlite3
+
+# Default rollup resolutions, hourly and daily
+ROLLUPS = (3600, 86400)
+
+BUCKET = "datetime((cast(strftime('%s', {ts}) as integer) / {res}) * {res}, 'unixepoch')"
+
+def table_name(res):
+    return "rollup_%d" % res
+
+def existing(dbc):
+    # Resolutions of all rollup tables in the database
+    return sorted(int(r[0][len("rollup_"):]) for r in dbc.execute(
+        "select name from sqlite_master where type = 'table' and name glob 'rollup_[0-9]*'"))
+
+def create_tables(dbc, rollups=ROLLUPS):
+    # Returns list of resolutions for which a new table was created
+    created = []
+    for res in rollups:
+        table = table_name(res)
+        cols = [r[1] for r in dbc.execute("pragma table_info(%s)" % table)]
+        if cols and 'station' not in cols:
+            # Replace table from before multi-station support
+            dbc.execute("drop table %s" % table)
+            cols = []
+
+        if not cols:
+            dbc.execute("create table %s (station text, ts timestamp, count integer, "
+                        "wind_sum float, gust_max float, temp_min float, "
+                        "temp_max float, temp_sum float, primary key (station, ts)) "
+                        "without rowid" % table)
+            created.append(res)
+
+        # For queries across all stations
+        dbc.execute("create index if not exists %s_ts on %s (ts)" % (table, table))
+
+    return created
+
+def update(dbc, rows, rollups=ROLLUPS):
+    # Add (station, ts, temp, wind, gust, ...) rows to their buckets
+    for res in rollups:
+        dbc.executemany(
+            "insert into {table} (station, ts, count, wind_sum, gust_max, temp_min, temp_max, temp_sum) "
+            "values (:station, {bucket}, 1, :wind, :gust, :temp, :temp, :temp) "
+            "on conflict (station, ts) do update set "
+            "count = count + 1, wind_sum = wind_sum + :wind, "
+            "gust_max = max(gust_max, :gust), temp_min = min(temp_min, :temp), "
+            "temp_max = max(temp_max, :temp), temp_sum = temp_sum + :temp".format(
+                table=table_name(res), bucket=BUCKET.format(ts=":ts", res=res)),
+            ({'station': r[0], 'ts': r[1], 'temp': r[2], 'wind': r[3], 'gust': r[4]}
+             for r in rows))
+
+def rebuild(dbc, rollups=ROLLUPS, start=None):
+    # Recompute buckets from the raw data at or after start (default the
+    # oldest reading in metlog). A bucket only partly after start keeps its
+    # existing values, it may hold archived readings.
+    if start is None:
+        start = dbc.execute("select min(ts) from metlog").fetchone()[0]
+        if start is None:
+            return
+
+    for res in rollups:
+        table = table_name(res)
+        whole = "datetime(((cast(strftime('%s', :start) as integer) + {res} - 1) / {res}) * {res}, " \
+                "'unixepoch')".format(res=res)
+        dbc.execute("delete from %s where ts >= %s" % (table, whole), {'start': start})
+        dbc.execute(
+            "insert or ignore into {table} (station, ts, count, wind_sum, gust_max, temp_min, temp_max, temp_sum) "
+            "select station, {bucket} as b, count(*), sum(wind), max(gust), min(temp), "
+            "max(temp), sum(temp) from metlog where ts >= :start group by station, b".format(
+                table=table, bucket=BUCKET.format(ts="ts", res=res)), {'start': start})
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rebuild rollup tables")
+    parser.add_argument("db_file", help="Database file")
+    parser.add_argument("--res", type=int, nargs="+", default=ROLLUPS,
+                        help="Rollup resolutions (seconds)")
+    parser.add_argument("--start",
+                        help="Rebuild from this time (default oldest reading in metlog), "
+                        "buckets before it are kept")
+    args = parser.parse_args()
+
+    dbc = sqlite3.connect(args.db_file)
+    with dbc:
+        create_tables(dbc, args.res)
+        rebuild(dbc, args.res, args.start)
+
+    dbc.close()
@@ -0,0 +1,66 @@
+from collections import deque
+
+from .window import Window
+
+# Number of recent readings kept in memory, a day of one minute results
+RECENT_SIZE = 1440
+
+# Shortest expected interval between readings, sets window capacity
+MIN_INTERVAL = 10
+
+class Station:
+    """
+    Aggregation state for a single met station
+    """
+    __slots__ = ('name', 'last_update', 'next_upload', 'windows',
+                 'min_temp', 'max_temp', 'max_gust', 'gust3', 'wind_sd',
+                 'temps', 'recent', 'seq', 'responses')
+
+    def __init__(self, name, ts, windows):
+        self.name = name
+        self.last_update = ts
+        self.next_upload = None
+
+        # Sliding wind windows, keyed by length in seconds
+        self.windows = {length: Window(length, length // MIN_INTERVAL + 1)
+                        for length in windows}
+
+        self.reset_min_max()
+
+        # Highest 3 second gust since the last upload and the latest wind
+        # standard deviation, None unless the sensor sends them
+        self.gust3 = None
+        self.wind_sd = None
+
+        # Latest per-probe temperatures from sensors with several probes
+        self.temps = None
+
+        # Recent (ts, wind, gust, temp) readings, update sequence number
+        # and cached HTTP responses for the current sequence number
+        self.recent = deque(maxlen=RECENT_SIZE)
+        self.seq = 0
+        self.responses = {}
+
+    def reset_min_max(self):
+        self.min_temp = 100
+        self.max_temp = -100
+        self.max_gust = 0
+
+    def add_reading(self, t, ts, wind, gust, temp):
+        for window in self.windows.values():
+            window.add(t, wind, gust)
+
+        self.recent.append((ts, wind, gust, temp))
+        self.seq += 1
+        if self.responses:
+            self.responses.clear()
+
+    def add_extremes(self, temp, gust):
+        # Reading that only counts towards today's extremes, e.g. replayed
+        # after an outage
+        self.min_temp = min(self.min_temp, temp)
+        self.max_temp = max(self.max_temp, temp)
+        self.max_gust = max(self.max_gust, gust)
+        self.seq += 1
+        if self.responses:
+            self.responses.clear()
@@ -1,7 +1,11 @@
 import calendar
+from collections import OrderedDict
 import math
 import datetime
 
+# Number of cached rise/set times
+CACHE_SIZE = 1024
+
 class SunTimeException(Exception):
     def __init__(self, message):
         super(SunTimeException, self).__init__(message)
@@ -11,13 +15,16 @@ class Sun:
     Approximated calculation of sunrise and sunset datetimes. Adapted from:
     https://stackoverflow.com/questions/19615350/calculate-sunrise-and-sunset-times-for-a-given-gps-coordinate-within-postgresql
     """
-    def __init__(self, lat, lon):
+    def __init__(self, lat, lon, cache_size=CACHE_SIZE):
         self._lat = lat
         self._lon = lon
 
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
     def get_sunrise_time(self, date=None):
         date = datetime.date.today() if date is None else date
-        sr = self._calc_sun_time(date, True)
+        sr = self._cached_sun_time(date, True)
         if sr is None:
             raise SunTimeException('The sun never rises on this location (on the specified date)')
         else:
@@ -25,12 +32,47 @@ class Sun:
 
     def get_sunset_time(self, date=None):
         date = datetime.date.today() if date is None else date
-        ss = self._calc_sun_time(date, False)
+        ss = self._cached_sun_time(date, False)
         if ss is None:
             raise SunTimeException('The sun never sets on this location (on the specified date)')
         else:
             return ss
 
+    def sun_times(self, dates, zenith=90.8):
+        """
+        Sunrise and sunset for an array of dates. Returns a pair of masked
+        datetime64[m] arrays, masked where the sun doesn't rise or set
+        """
+        return sun_times(dates, self._lat, self._lon, zenith)
+
+    def table(self, year, zenith=90.8):
+        """
+        Dates, sunrises and sunsets for every day of the year
+        """
+        import numpy as np
+
+        dates = np.arange(np.datetime64('%04d-01-01' % year),
+                          np.datetime64('%04d-01-01' % (year + 1)))
+        sunrise, sunset = self.sun_times(dates, zenith)
+        return dates, sunrise, sunset
+
+    def _cached_sun_time(self, date, isRiseTime):
+        key = (date, isRiseTime)
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        t = self._calc_sun_time(date, isRiseTime)
+
+        self._cache[key] = t
+        if len(self._cache) > self._cache_size:
+            # Evict least recently used
+            self._cache.popitem(last=False)
+
+        return t
+
     def _calc_sun_time(self, date, isRiseTime=True, zenith=90.8):
         day = date.day
         month = date.month
@@ -132,6 +174,98 @@ class Sun:
 
         return v
 
+def sun_times(dates, lat, lon, zenith=90.8):
+    """
+    Vectorised version of Sun._calc_sun_time. dates is an array of
+    datetime64 dates (or anything convertible), lat and lon are scalars
+    or arrays for many locations. Returns a (sunrise, sunset) pair of
+    masked datetime64[m] arrays with shape broadcast(lat, lon) + dates.shape,
+    masked where the sun never rises or sets. Needs numpy, which is only
+    imported here so the rest of metlog runs without it
+    """
+    import numpy as np
+
+    TO_RAD = np.pi/180.0
+
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    lat = np.asarray(lat, dtype=float)[..., np.newaxis]
+    lon = np.asarray(lon, dtype=float)[..., np.newaxis]
+
+    year_start = dates.astype('datetime64[Y]')
+    month_start = dates.astype('datetime64[M]')
+    year = year_start.astype(int) + 1970
+    month = (month_start - year_start).astype(int) + 1
+    day = (dates - month_start).astype(int) + 1
+
+    # 1. first calculate the day of the year
+    N1 = np.floor(275 * month / 9)
+    N2 = np.floor((month + 9) / 12)
+    N3 = (1 + np.floor((year - 4 * np.floor(year / 4) + 2) / 3))
+    N = N1 - (N2 * N3) + day - 30
+
+    # 2. convert the longitude to hour value
+    lngHour = lon / 15
+
+    results = []
+    for isRiseTime in (True, False):
+        # approximate time
+        if isRiseTime:
+            t = N + ((6 - lngHour) / 24)
+        else:
+            t = N + ((18 - lngHour) / 24)
+
+        # 3. calculate the Sun's mean anomaly
+        M = (0.9856 * t) - 3.289
+
+        # 4. calculate the Sun's true longitude
+        L = M + (1.916 * np.sin(TO_RAD*M)) + (0.020 * np.sin(TO_RAD * 2 * M)) + 282.634
+        L = _force_range(L, 360)
+
+        # 5a. calculate the Sun's right ascension
+        RA = (1/TO_RAD) * np.arctan(0.91764 * np.tan(TO_RAD*L))
+        RA = _force_range(RA, 360)
+
+        # 5b. right ascension value needs to be in the same quadrant as L
+        RA = RA + (np.floor(L/90) - np.floor(RA/90)) * 90
+
+        # 5c. right ascension value needs to be converted into hours
+        RA = RA / 15
+
+        # 6. calculate the Sun's declination
+        sinDec = 0.39782 * np.sin(TO_RAD*L)
+        cosDec = np.cos(np.arcsin(sinDec))
+
+        # 7a. calculate the Sun's local hour angle
+        cosH = (np.cos(TO_RAD*zenith) - (sinDec * np.sin(TO_RAD*lat))) / (cosDec * np.cos(TO_RAD*lat))
+        mask = (cosH > 1) | (cosH < -1)
+
+        # 7b. finish calculating H and convert into hours
+        H = (1/TO_RAD) * np.arccos(np.clip(cosH, -1, 1))
+        if isRiseTime:
+            H = 360 - H
+        H = H / 15
+
+        # 8. calculate local mean time of rising/setting
+        T = H + RA - (0.06571 * t) - 6.622
+
+        # 9. adjust back to UTC
+        UT = _force_range(T - lngHour, 24)
+
+        # 10. round to the minute, rolling over into the next day
+        hr = _force_range(np.trunc(UT), 24)
+        mins = hr * 60 + np.round((UT - np.trunc(UT)) * 60)
+        times = dates.astype('datetime64[m]') + mins.astype(int).astype('timedelta64[m]')
+
+        results.append(np.ma.masked_array(times, mask))
+
+    return tuple(results)
+
+def _force_range(v, max):
+    # Array version of Sun._force_range
+    import numpy as np
+
+    return np.where(v < 0, v + max, np.where(v >= max, v - max, v))
+
 if __name__ == '__main__':
     sun = Sun(51.0, -1.6)
     try:
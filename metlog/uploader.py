@@ -0,0 +1,205 @@
+import asyncio
+import gzip
+import json
+import random
+import sqlite3
+import time
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+# Request timeout (connect, read) in seconds
+TIMEOUT = (5, 10)
+
+# Retry backoff limits in seconds
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+
+# Most outbox entries sent in one batch request
+BATCH_SIZE = 500
+
+# Batch responses meaning the server doesn't accept batches
+BATCH_UNSUPPORTED = (404, 405, 501)
+
+# Client errors worth retrying, other 4xx responses drop the entries
+RETRY_STATUS = (408, 429)
+
+class Uploader:
+    """
+    Background uploader draining the outbox table. Requests are made from
+    a worker thread using a keep-alive session so the event loop is never
+    blocked. If batch_url is set a backlog (e.g. after an outage) is sent
+    there as gzipped JSON lists of up to BATCH_SIZE entries. Otherwise, or
+    if the server turns out not to accept batches, only the newest entry
+    of each station in the whole outbox is sent to its station URL and
+    older ones are dropped, as a newer aggregate replaces a stale one (the
+    readings are still in metlog). Entries are deleted once sent, superseded or
+    rejected by the server, failed requests and database errors are
+    retried with backoff.
+    """
+    def __init__(self, db_file, base_url, batch_url=None, timeout=TIMEOUT,
+                 batch_size=BATCH_SIZE):
+        self.db_file = db_file
+        self.base_url = base_url
+        self.batch_url = batch_url
+        self.timeout = timeout
+        self.batch_size = batch_size
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.dbc = None
+        self.backlog = 0
+        self.event = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        # Connection is only used by one executor call at a time
+        self.dbc = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        self.session.close()
+        if self.dbc is not None:
+            self.dbc.close()
+            self.dbc = None
+
+    def notify(self):
+        # New outbox entries have been committed
+        self.event.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        backoff = BACKOFF_MIN
+
+        while True:
+            self.event.clear()
+            try:
+                entries = await loop.run_in_executor(None, self.read)
+                if not entries:
+                    await self.event.wait()
+                    continue
+
+                t = time.perf_counter()
+                try:
+                    done = await loop.run_in_executor(None, self.send, entries)
+                finally:
+                    metrics.UPLOAD_SECONDS.observe(time.perf_counter() - t)
+
+                await loop.run_in_executor(None, self.delete, done)
+
+            except (requests.RequestException, sqlite3.Error) as e:
+                metrics.UPLOAD_ERRORS.inc()
+                print(str(e))
+
+                await asyncio.sleep(random.uniform(0, backoff))
+                backoff = min(backoff * 2, BACKOFF_MAX)
+
+            else:
+                metrics.UPLOADS.inc()
+                metrics.UPLOAD_LAST_SUCCESS.set_to_current_time()
+                backoff = BACKOFF_MIN
+
+    def read(self):
+        if self.batch_url is None:
+            # Newest entry of each station, the rest are superseded
+            entries = self.dbc.execute(
+                "select id, station, ts, data from outbox where id in "
+                "(select max(id) from outbox group by station) order by id").fetchall()
+            self.backlog = self.dbc.execute("select count(*) from outbox").fetchone()[0]
+            if self.backlog > len(entries):
+                print("Dropping %d superseded uploads" % (self.backlog - len(entries)))
+            return entries
+
+        entries = self.dbc.execute(
+            "select id, station, ts, data from outbox order by id limit ?",
+            (self.batch_size,)).fetchall()
+
+        if len(entries) == self.batch_size:
+            self.backlog = self.dbc.execute("select count(*) from outbox").fetchone()[0]
+        else:
+            self.backlog = len(entries)
+
+        return entries
+
+    def delete(self, entries):
+        # Each station's entries up to the newest done, entries added since
+        # the read are kept
+        newest = {}
+        for id, station, _, _ in entries:
+            newest[station] = max(id, newest.get(station, id))
+
+        with self.dbc:
+            self.dbc.executemany("delete from outbox where station = ? and id <= ?",
+                                 newest.items())
+
+    def send(self, entries):
+        # Returns the entries sent or rejected, older entries of the same
+        # stations are superseded. Raises RequestException if the first
+        # request made fails so nothing is counted as uploaded
+        if self.batch_url is not None and len(entries) > 1:
+            # Data is already JSON encoded
+            body = "[%s]" % ",".join(
+                '{"station": %s, "ts": %s, "data": %s}' % (json.dumps(station), json.dumps(ts), data)
+                for _, station, ts, data in entries)
+            resp = self.session.post(self.batch_url,
+                                     data=gzip.compress(body.encode()),
+                                     headers={'Content-Type': "application/json",
+                                              'Content-Encoding': "gzip"},
+                                     timeout=self.timeout)
+
+            if resp.status_code not in BATCH_UNSUPPORTED:
+                self.check(resp, len(entries))
+                return entries
+
+            print("Batch upload not supported (%d), sending entries singly" % resp.status_code)
+            self.batch_url = None
+
+        # Entries read for a batch may include several per station
+        newest = {}
+        for entry in entries:
+            newest[entry[1]] = entry
+
+        sent = []
+        for entry in sorted(newest.values()):
+            _, station, ts, data = entry
+
+            # Timestamped so the server can tell a late aggregate from a
+            # current one
+            body = json.dumps(dict(json.loads(data), ts=ts))
+            try:
+                resp = self.session.put(self.base_url + quote(station, safe=""), data=body,
+                                        headers={'Content-Type': "application/json"},
+                                        timeout=self.timeout)
+                self.check(resp, 1)
+            except requests.RequestException:
+                if not sent:
+                    raise
+                break
+
+            sent.append(entry)
+
+        return sent
+
+    def check(self, resp, count):
+        # A client error won't succeed on retry, drop the entries rather
+        # than block the outbox
+        if 400 <= resp.status_code < 500 and resp.status_code not in RETRY_STATUS:
+            metrics.UPLOAD_DROPPED.inc(count)
+            print("Upload rejected (%d), dropping %d entries" % (resp.status_code, count))
+            return
+
+        resp.raise_for_status()
@@ -0,0 +1,76 @@
+from array import array
+
+class Window:
+    """
+    Sliding time window of wind readings giving mean wind and max gust.
+    Readings are held in preallocated ring buffers, the maximum is kept
+    with a monotonic queue of buffer positions so each update is
+    amortised O(1). capacity is the most readings the window will hold,
+    older readings are dropped early if it fills.
+    """
+    def __init__(self, length, capacity):
+        self.length = length
+        self.capacity = capacity
+
+        self.times = array('d', bytes(8 * capacity))
+        self.winds = array('d', bytes(8 * capacity))
+        self.gusts = array('d', bytes(8 * capacity))
+
+        # Monotonic (decreasing gust) queue of sequence numbers
+        self.maxq = array('q', bytes(8 * capacity))
+
+        self.clear()
+
+    def clear(self):
+        # Sequence numbers of oldest and next readings, and max queue
+        self.head = 0
+        self.tail = 0
+        self.qhead = 0
+        self.qtail = 0
+
+        self.wind_sum = 0.0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def add(self, t, wind, gust):
+        # Drop expired readings, and oldest if buffer is full
+        start = t - self.length
+        while self.head < self.tail and (self.times[self.head % self.capacity] <= start or
+                                         self.tail - self.head == self.capacity):
+            self._pop()
+
+        i = self.tail % self.capacity
+        self.times[i] = t
+        self.winds[i] = wind
+        self.gusts[i] = gust
+        self.wind_sum += wind
+
+        # Remove queued readings that can no longer be the maximum
+        gusts = self.gusts
+        maxq = self.maxq
+        while self.qtail > self.qhead and gusts[maxq[(self.qtail - 1) % self.capacity] % self.capacity] <= gust:
+            self.qtail -= 1
+
+        maxq[self.qtail % self.capacity] = self.tail
+        self.qtail += 1
+        self.tail += 1
+
+    def _pop(self):
+        self.wind_sum -= self.winds[self.head % self.capacity]
+        if self.maxq[self.qhead % self.capacity] == self.head:
+            self.qhead += 1
+        self.head += 1
+
+        # Avoid accumulated rounding error
+        if self.head == self.tail:
+            self.wind_sum = 0.0
+
+    def mean_wind(self):
+        n = self.tail - self.head
+        return self.wind_sum / n if n else 0
+
+    def max_gust(self):
+        if self.qtail == self.qhead:
+            return 0
+        return self.gusts[self.maxq[self.qhead % self.capacity] % self.capacity]
@@ -0,0 +1,212 @@
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+import queue
+import sqlite3
+import threading
+import time
+
+from . import metrics
+from . import rollup
+
+# Group commit limits
+BATCH_SIZE = 100
+BATCH_DELAY = 1.0
+
+QUEUE_SIZE = 10000
+
+# Time to wait for another connection's lock (ms), e.g. an import, rollup
+# rebuild or vacuum, then time between retries of the group (seconds)
+BUSY_TIMEOUT = 30000
+RETRY_DELAY = 5.0
+
+# Replayed readings this close to a stored reading are duplicates
+DUPLICATE_WINDOW = timedelta(seconds=30)
+
+class DbWriter:
+    """
+    Database writer thread. Rows are queued from the event loop and
+    committed in groups, either when BATCH_SIZE rows are waiting or
+    BATCH_DELAY seconds after the first row of the group arrived. Rollup
+    tables are updated in the same transaction. Upload data is written to
+    the outbox table in the same way, and on_outbox (if set) is called
+    from the writer thread after it has been committed. Rollup tables
+    found in the database are maintained as well as those in rollups. A
+    group that fails because the database is locked is retried until it
+    commits, other errors drop the group.
+    """
+    def __init__(self, db_file, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY,
+                 queue_size=QUEUE_SIZE, rollups=rollup.ROLLUPS):
+        self.db_file = db_file
+        self.rollups = rollups
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.on_outbox = None
+
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="metlog-writer",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Flush remaining rows and wait for thread to finish
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def insert(self, station, ts, temp, wind, gust, gust3=None, wind_sd=None,
+               temps=None):
+        self.put(("metlog", (station, ts, temp, wind, gust, gust3, wind_sd)))
+        if temps is not None:
+            self.put(("probes", [(station, ts, probe, t) for probe, t in enumerate(temps)]))
+
+    def insert_many(self, station, rows, on_commit=None):
+        # Replayed (ts, temp, wind, gust, gust3, wind_sd, temps) rows, rows
+        # already in the database are skipped. on_commit (if set) is called
+        # from the writer thread once the rows have been committed.
+        self.put(("batch", (station, rows, on_commit)))
+
+    def outbox(self, station, ts, data):
+        # data is JSON encoded upload data
+        self.put(("outbox", (station, ts, data)))
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            metrics.DB_DROPPED.inc()
+            print("Database queue full, dropping", item[0], "row")
+
+    def connect(self):
+        dbc = sqlite3.connect(self.db_file)
+        dbc.execute("pragma journal_mode=wal")
+        dbc.execute("pragma synchronous=normal")
+        dbc.execute("pragma busy_timeout=%d" % BUSY_TIMEOUT)
+
+        # Keep tables created by "python -m metlog.rollup --res" up to date
+        self.rollups = sorted(set(self.rollups) | set(rollup.existing(dbc)))
+        return dbc
+
+    def run(self):
+        dbc = self.connect()
+
+        running = True
+        while running:
+            # Wait for the first row of a group
+            row = self.queue.get()
+            if row is None:
+                break
+
+            rows = [row]
+            deadline = time.monotonic() + self.batch_delay
+
+            # Collect further rows until batch is full or deadline expires
+            while len(rows) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+                try:
+                    row = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if row is None:
+                    running = False
+                    break
+
+                rows.append(row)
+
+            while not self.write(dbc, rows):
+                time.sleep(RETRY_DELAY)
+
+        dbc.close()
+
+    def write(self, dbc, items):
+        # Returns False if the group should be retried
+        t = time.perf_counter()
+
+        rows = [row for table, row in items if table == "metlog"]
+        outbox = [row for table, row in items if table == "outbox"]
+        batches = [row for table, row in items if table == "batch"]
+        probes = [row for table, rows in items if table == "probes" for row in rows]
+        try:
+            with dbc:
+                self.insert_rows(dbc, rows)
+
+                # Each batch is inserted before the next is checked
+                for station, batch, _ in batches:
+                    new, new_probes = self.new_rows(dbc, station, batch)
+                    self.insert_rows(dbc, new)
+                    rows.extend(new)
+                    probes.extend(new_probes)
+
+                if probes:
+                    dbc.executemany("insert or replace into probes (station, ts, probe, temp) "
+                                    "values (?, ?, ?, ?)", probes)
+
+                if outbox:
+                    dbc.executemany("insert into outbox (station, ts, data) values (?, ?, ?)",
+                                    outbox)
+
+        except sqlite3.OperationalError as e:
+            metrics.DB_ERRORS.inc()
+            if "locked" in str(e):
+                # SQLITE_BUSY or SQLITE_LOCKED, nothing was written
+                print("Database locked, retrying", len(items), "rows")
+                return False
+            print("Database error:", str(e))
+
+        except sqlite3.Error as e:
+            metrics.DB_ERRORS.inc()
+            print("Database error:", str(e))
+
+        else:
+            metrics.DB_ROWS.inc(len(rows))
+            metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - t)
+            metrics.DB_LAST_SUCCESS.set_to_current_time()
+
+            if outbox and self.on_outbox is not None:
+                self.on_outbox()
+
+            for _, _, on_commit in batches:
+                if on_commit is not None:
+                    on_commit()
+
+        return True
+
+    def insert_rows(self, dbc, rows):
+        dbc.executemany(
+            "insert into metlog (station, ts, temp, wind, gust, gust3, wind_sd) "
+            "values (?, ?, ?, ?, ?, ?, ?)",
+            rows)
+        rollup.update(dbc, rows, self.rollups)
+
+    def new_rows(self, dbc, station, batch):
+        # Readings may be replayed more than once with slightly different
+        # times, skip any close to a stored reading. Stored times come from
+        # one range query on the (station, ts) index.
+        start = min(row[0] for row in batch) - DUPLICATE_WINDOW
+        end = max(row[0] for row in batch) + DUPLICATE_WINDOW
+        seen = sorted(datetime.fromisoformat(ts) for ts, in dbc.execute(
+            "select ts from metlog where station = ? and ts between ? and ?",
+            (station, start, end)))
+
+        rows = []
+        probes = []
+        for row in batch:
+            ts = row[0]
+            i = bisect_left(seen, ts)
+            if ((i < len(seen) and seen[i] - ts < DUPLICATE_WINDOW) or
+                    (i > 0 and ts - seen[i - 1] < DUPLICATE_WINDOW)):
+                continue
+
+            insort(seen, ts)
+            rows.append((station,) + row[:-1])
+            if row[-1] is not None:
+                probes.extend((station, ts, probe, t) for probe, t in enumerate(row[-1]))
+
+        return rows, probes
@@ -3,7 +3,33 @@ import signal
 
 import gmqtt
 
-from metlog import MqttClient, Sun, ask_exit, init_db
+from metlog import MqttClient, Sun, ask_exit, init_db, migrate_db
+from metlog.metlog import METCLOUD_BATCH, WINDOWS
+from metlog.rollup import ROLLUPS
+from metlog.httpapi import ApiServer
+from metlog.metrics import MetricsServer
+from metlog.profiling import Profiler
+from metlog.retention import Retention
+
+PROFILE_TOPIC = "metlog/control/profile"
+
+async def main(mqtt_client, profiler, args):
+    servers = []
+    if args.http_port:
+        servers.append(ApiServer(mqtt_client, args.http_host, args.http_port))
+    if args.metrics_port:
+        servers.append(MetricsServer(args.http_host, args.metrics_port))
+
+    for server in servers:
+        await server.start()
+
+    await mqtt_client.main(args.mqtt)
+
+    for server in servers:
+        await server.stop()
+
+    # Write any profile in progress
+    profiler.stop()
 
 if __name__ == '__main__':
     import argparse
@@ -13,18 +39,48 @@ if __name__ == '__main__':
     parser.add_argument("db_file", help="Database file")
     parser.add_argument("--init", action="store_true",
                         help="Initialise database")
+    parser.add_argument("--archive-dir",
+                        help="Archive old readings to this directory")
+    parser.add_argument("--retain-days", type=int, default=365,
+                        help="Age of readings to archive (days)")
+    parser.add_argument("--windows", type=int, nargs="+", default=WINDOWS,
+                        help="Sliding wind window lengths (seconds)")
+    parser.add_argument("--rollups", type=int, nargs="+", default=ROLLUPS,
+                        help="Rollup resolutions (seconds)")
+    parser.add_argument("--http-port", type=int,
+                        help="Serve current readings over HTTP on this port")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics on this port")
+    parser.add_argument("--profile-dir", default=".",
+                        help="Directory for profiles (SIGUSR1 to start/stop)")
+    parser.add_argument("--http-host", default="localhost",
+                        help="HTTP and metrics server address")
+    parser.add_argument("--metcloud-batch", metavar="URL", default=METCLOUD_BATCH,
+                        help="Send upload backlogs to this batch URL, otherwise "
+                        "only the newest upload of each station is sent")
     args = parser.parse_args()
 
     if args.init:
-        init_db(args.db_file)
+        init_db(args.db_file, args.rollups)
+    else:
+        migrate_db(args.db_file, args.rollups)
+
+    if args.archive_dir:
+        Retention(args.db_file, args.archive_dir, args.retain_days).start()
 
     sun = Sun(51.0, -1.6)
 
     mqtt = gmqtt.Client('metlog')
-    mqtt_client = MqttClient(mqtt, args.db_file, sun)
+    mqtt_client = MqttClient(mqtt, args.db_file, sun, args.windows, args.rollups,
+                             args.metcloud_batch)
 
     loop = asyncio.get_event_loop()
     loop.add_signal_handler(signal.SIGINT, ask_exit)
     loop.add_signal_handler(signal.SIGTERM, ask_exit)
 
-    loop.run_until_complete(mqtt_client.main(args.mqtt))
+    # Profiling started/stopped by signal or MQTT control message
+    profiler = Profiler(args.profile_dir)
+    loop.add_signal_handler(signal.SIGUSR1, profiler.toggle)
+    mqtt_client.add_control(PROFILE_TOPIC, profiler.control)
+
+    loop.run_until_complete(main(mqtt_client, profiler, args))
@@ -0,0 +1,12 @@
+"""
+CPython simulator for the pymet firmware. Stand-ins for the MicroPython
+modules (machine, onewire, ds18x20, micropython, usocket, ...) in
+sim/micro run the firmware unchanged on a simulated clock against
+scripted wind and temperature traces, publishing through an in-process
+broker to the real metlog.MqttClient.
+
+    python -m sim [--hours 24] [--wind-sensor high] [--output results.json]
+"""
+from .broker import Broker, HostClient
+from .clock import Clock
+from .simulation import Simulation
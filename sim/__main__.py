@@ -0,0 +1,61 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from . import traces
+from .simulation import Simulation
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=os.path.dirname(__file__),
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the firmware against the host on a simulated clock")
+    parser.add_argument("--hours", type=float, default=1.0, help="Simulated time (hours)")
+    parser.add_argument("--wind-sensor", choices=["high", "raw", "float"], default="high")
+    parser.add_argument("--json", action="store_true", help="Publish JSON results")
+    parser.add_argument("--wind", type=float, default=5.0, help="Mean wind (m/s)")
+    parser.add_argument("--gust", type=float, default=3.0, help="Gust amplitude (m/s)")
+    parser.add_argument("--temp", type=float, nargs="+", default=[10.0],
+                        help="Mean temperature of each probe (C)")
+    parser.add_argument("--trace", help="CSV trace with t, wind and temp columns")
+    parser.add_argument("--db", help="Database file (default temporary)")
+    parser.add_argument("--log", help="Firmware and host output (default discarded)")
+    parser.add_argument("--output", help="Output file (default stdout)")
+    args = parser.parse_args()
+
+    if args.trace:
+        wind = traces.from_csv(args.trace, 'wind')
+        temps = [traces.from_csv(args.trace, 'temp')]
+    else:
+        wind = traces.gusty(args.wind, args.gust)
+        temps = [traces.diurnal(t) for t in args.temp]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_file = args.db or os.path.join(tmpdir, "metlog.db")
+        sim = Simulation(db_file, args.hours, wind, temps, args.wind_sensor,
+                         not args.json, args.log)
+        result = sim.run()
+
+    print("%(sim_seconds).0f s simulated at %(speedup).0fx, %(host_messages)d messages, "
+          "timer p99 %(timer_p99_us).1f us, host p99 %(host_p99_us).1f us, "
+          "%(payload_mismatches)d payload mismatches" % result,
+          file=sys.stderr)
+
+    report = {'version': version(), 'python': sys.version.split()[0],
+              'config': vars(args), 'result': result}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,178 @@
+from array import array
+import struct
+import time
+
+def topic_matches(pattern, topic):
+    pattern = pattern.split('/')
+    topic = topic.split('/')
+    for i, p in enumerate(pattern):
+        if p == '#':
+            return True
+        if i >= len(topic) or (p != '+' and p != topic[i]):
+            return False
+    return len(pattern) == len(topic)
+
+class Broker:
+    """
+    In-process MQTT broker stand-in. Routes messages between the host
+    client and device connections, keeping retained messages. Deliveries
+    are synchronous, so a device publish has been handled by the host
+    by the time the socket write returns.
+    """
+    def __init__(self):
+        self.subscriptions = []
+        self.retained = {}
+
+        self.messages = 0
+        self.bytes = 0
+
+    def subscribe(self, client, pattern):
+        self.subscriptions.append((pattern, client))
+        for topic, payload in self.retained.items():
+            if topic_matches(pattern, topic):
+                client.deliver(topic, payload, True)
+
+    def publish(self, topic, payload, retain=False):
+        self.messages += 1
+        self.bytes += len(payload)
+
+        if retain:
+            self.retained[topic] = payload
+
+        for pattern, client in self.subscriptions:
+            if topic_matches(pattern, topic):
+                client.deliver(topic, payload, False)
+
+    def disconnect(self, client):
+        self.subscriptions = [s for s in self.subscriptions if s[1] is not client]
+
+class HostClient:
+    """
+    gmqtt.Client stand-in for metlog.MqttClient, recording how long each
+    delivered message took to handle
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_message = None
+        self.message_seconds = array('d')
+
+    def connect(self):
+        self.on_connect(self, 0, 0, None)
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscribe(self, topic)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.broker.publish(topic, payload, retain)
+
+    def deliver(self, topic, payload, retain):
+        t = time.perf_counter()
+        self.on_message(self, topic, payload, 0, None)
+        self.message_seconds.append(time.perf_counter() - t)
+
+class DeviceConnection:
+    """
+    Broker end of a usocket connection. Parses MQTT packets written by the
+    device and queues responses and subscribed messages in rx.
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.connected = True
+
+    def receive(self, data):
+        self.tx += data
+        while True:
+            pkt = self.parse()
+            if pkt is None:
+                return
+            self.handle(*pkt)
+
+    def parse(self):
+        tx = self.tx
+        if len(tx) < 2:
+            return None
+
+        sz = 0
+        sh = 0
+        i = 1
+        while True:
+            if i == len(tx):
+                return None
+            b = tx[i]
+            i += 1
+            sz |= (b & 0x7f) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+
+        if len(tx) - i < sz:
+            return None
+
+        op = tx[0]
+        body = bytes(tx[i:i + sz])
+        del tx[:i + sz]
+        return op, body
+
+    def handle(self, op, body):
+        kind = op & 0xf0
+        if kind == 0x10:
+            # CONNECT
+            self.rx += b"\x20\x02\0\0"
+
+        elif kind == 0x80:
+            # SUBSCRIBE
+            pos = 2
+            qos = []
+            patterns = []
+            while pos < len(body):
+                n, = struct.unpack_from("!H", body, pos)
+                patterns.append(body[pos + 2:pos + 2 + n].decode())
+                qos.append(0)
+                pos += 3 + n
+
+            self.rx += bytes((0x90, 2 + len(qos))) + body[:2] + bytes(qos)
+            for pattern in patterns:
+                self.broker.subscribe(self, pattern)
+
+        elif kind == 0x30:
+            # PUBLISH
+            n, = struct.unpack_from("!H", body)
+            topic = body[2:2 + n].decode()
+            pos = 2 + n
+            if op & 6:
+                pid = body[pos:pos + 2]
+                pos += 2
+                self.rx += b"\x40\x02" + pid
+
+            self.broker.publish(topic, body[pos:], bool(op & 1))
+
+        elif kind == 0xc0:
+            # PINGREQ
+            self.rx += b"\xd0\0"
+
+        elif kind == 0xe0:
+            # DISCONNECT
+            self.close()
+
+    def deliver(self, topic, payload, retain):
+        topic = topic.encode()
+        body = struct.pack("!H", len(topic)) + topic + payload
+
+        hdr = bytearray((0x30 | retain,))
+        sz = len(body)
+        while sz > 0x7f:
+            hdr.append((sz & 0x7f) | 0x80)
+            sz >>= 7
+        hdr.append(sz)
+
+        self.rx += hdr + body
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            self.broker.disconnect(self)
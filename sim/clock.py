@@ -0,0 +1,54 @@
+from array import array
+import heapq
+import time
+
+class Clock:
+    """
+    Simulated clock in integer milliseconds. advance() runs timer
+    callbacks in deadline order as fast as they execute, recording how
+    long each callback took. stop_at (seconds) is when utime.sleep()
+    raises KeyboardInterrupt to end the firmware main loop.
+    """
+    def __init__(self, start=None):
+        self.start = time.time() if start is None else start
+        self.ms = 0
+        self.stop_at = None
+
+        self.timers = []
+        self.seq = 0
+        self.callback_seconds = array('d')
+
+    @property
+    def now(self):
+        # Seconds since start
+        return self.ms / 1000
+
+    def time(self):
+        return self.start + self.ms / 1000
+
+    def schedule(self, timer, deadline):
+        self.seq += 1
+        timer.seq = self.seq
+        heapq.heappush(self.timers, (deadline, self.seq, timer))
+
+    def advance(self, secs):
+        end = self.ms + round(secs * 1000)
+        timers = self.timers
+        while timers and timers[0][0] <= end:
+            deadline, seq, timer = heapq.heappop(timers)
+            if timer.seq != seq:
+                # Cancelled or re-initialised
+                continue
+
+            self.ms = deadline
+            if timer.periodic:
+                self.schedule(timer, deadline + timer.period)
+
+            t = time.perf_counter()
+            timer.callback(timer)
+            self.callback_seconds.append(time.perf_counter() - t)
+
+        self.ms = end
+
+    def stopped(self):
+        return self.stop_at is not None and self.now >= self.stop_at
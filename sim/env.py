@@ -0,0 +1,16 @@
+"""
+Shared simulation state for the MicroPython stand-in modules, set up by
+Simulation before the firmware is imported.
+"""
+
+# Clock driving utime and machine.Timer
+CLOCK = None
+
+# Broker that usocket connections attach to
+BROKER = None
+
+# Wind trace, m/s as a function of simulated seconds
+WIND = None
+
+# Temperature traces, one per DS18x20 probe on the bus
+TEMPS = []
@@ -0,0 +1,22 @@
+from onewire import OneWireError
+from sim import env
+
+class DS18X20:
+    def __init__(self, onewire):
+        self.ow = onewire
+        self.converted = None
+
+    def scan(self):
+        return self.ow.scan()
+
+    def convert_temp(self):
+        # Broadcast to every probe on the bus
+        self.converted = env.CLOCK.now
+
+    def read_temp(self, rom):
+        if self.converted is None:
+            raise OneWireError("no conversion")
+
+        # 12 bit resolution, value at the time of the conversion
+        t = env.TEMPS[rom[-1]](self.converted)
+        return round(t * 16) / 16
@@ -0,0 +1,80 @@
+from sim import env
+
+PWRON_RESET = 1
+HARD_RESET = 2
+WDT_RESET = 3
+DEEPSLEEP_RESET = 4
+SOFT_RESET = 5
+
+class Reset(SystemExit):
+    pass
+
+def reset():
+    raise Reset("machine.reset()")
+
+def reset_cause():
+    return PWRON_RESET
+
+def unique_id():
+    return b"sim"
+
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, id, mode=IN, value=None):
+        self.id = id
+        self.mode = mode
+        self.val = value or 0
+
+    def value(self, val=None):
+        if val is None:
+            return self.val
+        self.val = val
+
+    def on(self):
+        self.val = 1
+
+    def off(self):
+        self.val = 0
+
+class ADC:
+    # Anemometer output, inverse of pymet.counts_to_wind
+    def __init__(self, pin):
+        self.pin = pin
+
+    def read_u16(self):
+        counts = round((env.WIND(env.CLOCK.now) + 8.1) * 980.7)
+        return max(0, min(65535, counts))
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1):
+        self.id = id
+        self.seq = None
+        self.periodic = False
+        self.period = 0
+        self.callback = None
+
+    def init(self, mode=PERIODIC, period=-1, freq=-1, callback=None):
+        self.periodic = mode == Timer.PERIODIC
+        self.period = period if period > 0 else round(1000 / freq)
+        self.callback = callback
+        env.CLOCK.schedule(self, env.CLOCK.ms + self.period)
+
+    def deinit(self):
+        self.seq = None
+
+class WDT:
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.feeds = 0
+        self.last = env.CLOCK.ms
+
+    def feed(self):
+        if env.CLOCK.ms - self.last > self.timeout:
+            raise Reset("WDT timeout")
+        self.feeds += 1
+        self.last = env.CLOCK.ms
@@ -0,0 +1,16 @@
+def const(x):
+    return x
+
+def schedule(f, arg):
+    f(arg)
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+def native(f):
+    return f
+
+def viper(f):
+    # Viper pointer types don't exist in CPython. Fail as a MicroPython
+    # build without native code does, so callers fall back.
+    raise SyntaxError("invalid micropython decorator")
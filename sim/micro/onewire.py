@@ -0,0 +1,11 @@
+from sim import env
+
+class OneWireError(Exception):
+    pass
+
+class OneWire:
+    def __init__(self, pin):
+        self.pin = pin
+
+    def scan(self):
+        return [bytearray(b"\x28\0\0\0\0\0\0" + bytes((i,))) for i in range(len(env.TEMPS))]
@@ -0,0 +1,9 @@
+from asyncio import *
+
+class ThreadSafeFlag(Event):
+    async def wait(self):
+        await super().wait()
+        self.clear()
+
+def wait_for_ms(aw, timeout):
+    return wait_for(aw, timeout / 1000)
@@ -0,0 +1,21 @@
+import errno
+
+POLLIN = 1
+POLLOUT = 4
+
+class poll:
+    def __init__(self):
+        self.objs = []
+
+    def register(self, obj, mask=POLLIN):
+        self.objs.append(obj)
+
+    def unregister(self, obj):
+        self.objs.remove(obj)
+
+    def poll(self, timeout=-1):
+        ready = [(obj, POLLIN) for obj in self.objs if obj.readable()]
+        if not ready and timeout < 0:
+            # Nothing else can make data arrive
+            raise OSError(errno.ETIMEDOUT)
+        return ready
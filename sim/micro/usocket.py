@@ -0,0 +1,62 @@
+import errno
+
+from sim import env
+from sim.broker import DeviceConnection
+
+AF_INET = 2
+SOCK_STREAM = 1
+
+def getaddrinfo(host, port, *args):
+    return [(AF_INET, SOCK_STREAM, 0, '', (host, port))]
+
+class socket:
+    """
+    Socket connected to the in-process broker. Responses are queued before
+    the write that caused them returns, so a blocking read with nothing
+    waiting would never complete and raises ETIMEDOUT instead.
+    """
+    def __init__(self, *args):
+        self.conn = None
+        self.blocking = True
+
+    def connect(self, addr):
+        self.conn = DeviceConnection(env.BROKER)
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def write(self, buf, n=None):
+        if not self.conn.connected:
+            raise OSError(errno.ECONNRESET)
+        data = bytes(buf[:n] if n is not None else buf)
+        self.conn.receive(data)
+        return len(data)
+
+    send = write
+
+    def readable(self):
+        return bool(self.conn.rx) or not self.conn.connected
+
+    def read(self, n):
+        rx = self.conn.rx
+        if not rx:
+            if not self.conn.connected:
+                return b""
+            if not self.blocking:
+                return None
+            raise OSError(errno.ETIMEDOUT)
+
+        data = bytes(rx[:n])
+        del rx[:n]
+        return data
+
+    def readinto(self, buf, n=None):
+        data = self.read(len(buf) if n is None else n)
+        if data is None:
+            return None
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
@@ -0,0 +1,35 @@
+import time as _time
+
+from sim import env
+
+def time():
+    return int(env.CLOCK.time())
+
+def sleep(secs):
+    env.CLOCK.advance(secs)
+    if env.CLOCK.stopped():
+        raise KeyboardInterrupt
+
+def sleep_ms(ms):
+    sleep(ms / 1000)
+
+def sleep_us(us):
+    sleep(us / 1000000)
+
+def ticks_ms():
+    return env.CLOCK.ms
+
+def ticks_us():
+    return env.CLOCK.ms * 1000
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+def ticks_diff(a, b):
+    return a - b
+
+def localtime(secs=None):
+    return _time.localtime(time() if secs is None else secs)[:8]
+
+def gmtime(secs=None):
+    return _time.gmtime(time() if secs is None else secs)[:8]
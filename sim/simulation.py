@@ -0,0 +1,186 @@
+import contextlib
+import importlib
+import os
+import sqlite3
+import sys
+import time
+
+from . import env
+from . import traces
+from .broker import Broker, HostClient
+from .clock import Clock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MICRO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "micro")
+FIRMWARE_DIR = os.path.join(ROOT, "firmware")
+
+# Firmware modules, reloaded for each run
+FIRMWARE_MODULES = ("pymet", "mqtt_simple", "mqtt_async", "store", "wind_viper")
+
+# Station location for sun times
+LAT = 51.0
+LON = -1.6
+
+def install():
+    # Stand-in modules ahead of the firmware so its imports resolve
+    for path in (FIRMWARE_DIR, MICRO_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+class HostTime:
+    """
+    time module for metlog.metlog with time() from the simulated clock,
+    so database timestamps follow the firmware
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.perf_counter = time.perf_counter
+
+    def time(self):
+        return self.clock.time()
+
+class PayloadCheck:
+    """
+    Broker subscriber checking that each binary result published by the
+    firmware is what metlog.payload.encode produces from the decoded
+    values, so the host structs stay in step with pymet.publish_binary
+    """
+    def __init__(self, broker):
+        self.checked = 0
+        self.mismatches = 0
+        broker.subscribe(self, "metsensor/results")
+
+    def deliver(self, topic, payload, retain):
+        from metlog import payload as metlog_payload
+
+        if payload[0] not in (metlog_payload.VERSION_1, metlog_payload.VERSION_2,
+                              metlog_payload.VERSION_3):
+            return
+
+        _, flags, reset_cause, _, _, _, up_count = metlog_payload.STRUCT_1.unpack_from(payload)
+        wind, gust, temp, gust3, wind_sd, temps = metlog_payload.decode(payload)
+        encoded = metlog_payload.encode(wind, gust, temp, reset_cause, up_count,
+                                        bool(flags & metlog_payload.FLAG_FAN),
+                                        gust3, wind_sd, temps)
+        self.checked += 1
+        if encoded != bytes(payload):
+            self.mismatches += 1
+            print("Payload mismatch:", bytes(payload).hex(), encoded.hex())
+
+class Simulation:
+    """
+    Runs the firmware main loop (pymet.pymet) against scripted traces at
+    simulated time, connected through the in-process broker to a
+    metlog.MqttClient writing to db_file. The firmware is run with the
+    polled mqtt_simple client, its uasyncio client needs an event loop
+    on the simulated clock.
+
+    wind_sensor is "high" (HighRateWindSensor), "raw" (RawWindSensor) or
+    "float" (WindSensor).
+    """
+    def __init__(self, db_file, hours=1.0, wind=None, temps=None,
+                 wind_sensor="high", binary=True, log=None):
+        self.db_file = db_file
+        self.hours = hours
+        self.wind = wind or traces.gusty()
+        self.temps = temps or [traces.diurnal()]
+        self.wind_sensor = wind_sensor
+        self.binary = binary
+        self.log = log
+
+        self.clock = None
+        self.broker = None
+        self.check = None
+
+    def firmware(self):
+        install()
+        for name in FIRMWARE_MODULES:
+            sys.modules.pop(name, None)
+
+        pymet = importlib.import_module("pymet")
+        pymet.MQTT_ASYNC = False
+        pymet.BINARY_RESULTS = self.binary
+        pymet.WIND_HIGH_RATE = self.wind_sensor == "high"
+        pymet.WIND_RAW_SAMPLING = self.wind_sensor == "raw"
+        return pymet
+
+    def run(self):
+        from metlog import MqttClient, Sun, init_db
+        import metlog.metlog
+
+        env.CLOCK = self.clock = Clock()
+        env.BROKER = self.broker = Broker()
+        env.WIND = self.wind
+        env.TEMPS = self.temps
+
+        pymet = self.firmware()
+        import machine
+
+        if not os.path.exists(self.db_file):
+            init_db(self.db_file)
+
+        host_mqtt = HostClient(self.broker)
+        client = MqttClient(host_mqtt, self.db_file, Sun(LAT, LON))
+        self.check = PayloadCheck(self.broker)
+
+        host_time = metlog.metlog.time
+        metlog.metlog.time = HostTime(self.clock)
+
+        log = open(self.log, "w") if self.log else open(os.devnull, "w")
+        reset = None
+        client.writer.start()
+        try:
+            with contextlib.redirect_stdout(log):
+                host_mqtt.connect()
+
+                self.clock.stop_at = self.hours * 3600
+                start = time.perf_counter()
+                try:
+                    pymet.pymet(machine.WDT(timeout=30000))
+                except machine.Reset as e:
+                    reset = str(e)
+                run_time = time.perf_counter() - start
+
+        finally:
+            # Wait for the database to catch up
+            client.writer.stop()
+            wall_time = time.perf_counter() - start
+            metlog.metlog.time = host_time
+            log.close()
+
+        return self.report(host_mqtt, run_time, wall_time, reset)
+
+    def report(self, host_mqtt, run_time, wall_time, reset):
+        dbc = sqlite3.connect(self.db_file)
+        rows, wind, temp = dbc.execute("select count(*), avg(wind), avg(temp) from metlog").fetchone()
+        outbox = dbc.execute("select count(*) from outbox").fetchone()[0]
+        dbc.close()
+
+        callbacks = sorted(self.clock.callback_seconds)
+        messages = sorted(host_mqtt.message_seconds)
+        sim_time = self.clock.now
+
+        return {'sim_seconds': sim_time,
+                'wall_seconds': wall_time,
+                'speedup': sim_time / run_time,
+                'timer_callbacks': len(callbacks),
+                'timer_p50_us': percentile(callbacks, 50) * 1e6,
+                'timer_p99_us': percentile(callbacks, 99) * 1e6,
+                'timer_max_us': callbacks[-1] * 1e6 if callbacks else 0,
+                'host_messages': len(messages),
+                'host_messages_per_s': len(messages) / wall_time,
+                'host_p50_us': percentile(messages, 50) * 1e6,
+                'host_p99_us': percentile(messages, 99) * 1e6,
+                'broker_messages': self.broker.messages,
+                'payloads_checked': self.check.checked,
+                'payload_mismatches': self.check.mismatches,
+                'db_rows': rows,
+                'db_wind_mean': wind,
+                'db_temp_mean': temp,
+                'outbox': outbox,
+                'reset': reset}
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
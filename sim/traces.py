@@ -0,0 +1,46 @@
+"""
+Scripted wind (m/s) and temperature (C) traces, functions of simulated
+seconds since the start of the run
+"""
+import bisect
+import csv
+import math
+import random
+
+def constant(value):
+    return lambda t: value
+
+def gusty(mean=5.0, gust=3.0, period=20.0, noise=0.5, seed=0):
+    # Mean wind with periodic gusts and deterministic noise
+    rng = random.Random(seed)
+    def wind(t):
+        w = mean + gust * max(0.0, math.sin(2 * math.pi * t / period)) + rng.gauss(0, noise)
+        return max(0.0, w)
+    return wind
+
+def diurnal(mean=10.0, amplitude=5.0, peak=15 * 3600, start=0):
+    # Daily sine wave peaking at peak seconds after midnight, start is the
+    # time of day at the start of the run
+    return lambda t: mean + amplitude * math.cos(2 * math.pi * (start + t - peak) / 86400)
+
+def from_csv(path, column):
+    # Linear interpolation of a CSV file with a header row, t (seconds)
+    # in the first column
+    times = []
+    values = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            times.append(float(row['t']))
+            values.append(float(row[column]))
+
+    def trace(t):
+        i = bisect.bisect_right(times, t)
+        if i == 0:
+            return values[0]
+        if i == len(times):
+            return values[-1]
+        t0, t1 = times[i - 1], times[i]
+        v0, v1 = values[i - 1], values[i]
+        return v0 + (v1 - v0) * (t - t0) / (t1 - t0)
+
+    return trace
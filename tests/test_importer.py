@@ -0,0 +1,50 @@
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from metlog import init_db
+from metlog import importer
+
+START = datetime(2020, 1, 1)
+
+def readings(first, count, station=''):
+    return ((station, START + timedelta(minutes=i), 1.0, 2.0, 10.0, None, None)
+            for i in range(first, first + count))
+
+def index_exists(dbc):
+    return dbc.execute("select 1 from sqlite_master where type = 'index' "
+                       "and name = 'metlog_station_ts'").fetchone() is not None
+
+def test_reimport_overlapping(tmp_path):
+    db_file = str(tmp_path / "metlog.db")
+    init_db(db_file)
+    dbc = sqlite3.connect(db_file)
+
+    assert importer.import_rows(dbc, readings(0, 200000)) == (200000, 200000)
+    assert index_exists(dbc)
+
+    # 20000 duplicates and 1000 new rows. Checking each staged row against
+    # the whole table (O(staged x table)) takes minutes.
+    t = time.perf_counter()
+    count, inserted = importer.import_rows(dbc, readings(180000, 21000))
+    elapsed = time.perf_counter() - t
+
+    assert (count, inserted) == (21000, 1000)
+    assert elapsed < 10
+
+    assert dbc.execute("select count(*) from metlog").fetchone()[0] == 201000
+    assert dbc.execute("select sum(count) from rollup_86400").fetchone()[0] == 201000
+    assert index_exists(dbc)
+
+    dbc.close()
+
+def test_import_other_station(tmp_path):
+    db_file = str(tmp_path / "metlog.db")
+    init_db(db_file)
+    dbc = sqlite3.connect(db_file)
+
+    importer.import_rows(dbc, readings(0, 1000))
+    assert importer.import_rows(dbc, readings(0, 1000, "b")) == (1000, 1000)
+    assert dbc.execute("select count(*) from metlog").fetchone()[0] == 2000
+
+    dbc.close()